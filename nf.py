@@ -1,14 +1,42 @@
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Type, Union
 from langchain_core.tools import BaseTool
+from pydantic import BaseModel, Field
 import google.generativeai as genai
 import json
 import os
 import sys
-from datetime import datetime
+from datetime import datetime, timezone
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 import smtplib
 import re
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import argparse
+import bisect
+import cProfile
+import pstats
+import tracemalloc
+from collections import deque, OrderedDict
+from operator import mul
+import base64
+import csv
+import sqlite3
+import difflib
+import unicodedata
+import socket
+import multiprocessing
+import zlib
+import hashlib
+import copy
+import asyncio
+import functools
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from email.mime.text import MIMEText
@@ -21,6 +49,21 @@ from tkinter import filedialog
 genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
 model = genai.GenerativeModel('gemini-2.5-pro')
 
+# Schema da resposta JSON usada na análise em lote (uma entrada por nota fiscal)
+BATCH_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "id": {"type": "string"},
+            "resumo": {"type": "string"},
+            "avaliacao_risco": {"type": "string"},
+            "acoes_recomendadas": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["id", "resumo", "avaliacao_risco", "acoes_recomendadas"]
+    }
+}
+
 class InvoiceValidator:
     def __init__(self):
         self.tax_rules = self._load_tax_rules()
@@ -54,9 +97,998 @@ class InvoiceValidator:
             }
         }
 
+def decode_xml_bytes(data: bytes) -> str:
+    """Decodifica o conteúdo de um XML tentando diferentes codificações."""
+    encodings = ['utf-8', 'iso-8859-1', 'latin1', 'cp1252']
+    for encoding in encodings:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    
+    # Se nenhuma codificação funcionou, descarta os bytes inválidos
+    return data.decode('utf-8', errors='ignore')
+
+def read_xml_file(file_path: str) -> str:
+    """Lê um arquivo XML tentando diferentes codificações."""
+    with open(file_path, 'rb') as f:
+        return decode_xml_bytes(f.read())
+
+def _strip_xml_declaration(xml_string: str) -> str:
+    """Remove BOM e declaração XML (o lxml não aceita texto unicode com declaração de codificação)."""
+    return re.sub(r'^\s*<\?xml[^>]*\?>', '', xml_string.lstrip('\ufeff'))
+
+# Schemas compilados, compartilhados por todas as threads do processo
+_SCHEMA_CACHE: Dict[str, object] = {}
+_SCHEMA_CACHE_LOCK = threading.Lock()
+
+class NFeSchemaValidator:
+    """Valida o XML original da NF-e contra os XSDs oficiais (leiaute 4.00).
+    
+    Os arquivos do pacote de schemas do Portal da NF-e devem estar em
+    `schema_dir` (por padrão, a pasta `schemas` ao lado deste arquivo).
+    Cada XSD é compilado uma única vez por processo, sem acesso à rede.
+    """
+    SCHEMA_FILES = {
+        "nfeProc": "procNFe_v4.00.xsd",
+        "NFe": "nfe_v4.00.xsd",
+    }
+
+    def __init__(self, schema_dir: Optional[str] = None, max_errors: int = 20):
+        try:
+            from lxml import etree
+        except ImportError:
+            raise RuntimeError("A validação de schema requer o pacote lxml (pip install lxml)")
+        self._etree = etree
+        self.schema_dir = schema_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+        self.max_errors = max_errors
+        self._parser = etree.XMLParser(no_network=True, resolve_entities=False, huge_tree=False)
+
+    def _load_schema(self, file_name: str):
+        path = os.path.join(self.schema_dir, file_name)
+        with _SCHEMA_CACHE_LOCK:
+            cached = _SCHEMA_CACHE.get(path)
+            if cached is None:
+                if not os.path.exists(path):
+                    raise ValueError(f"Schema {file_name} não encontrado em {self.schema_dir}")
+                schema_doc = self._etree.parse(path, self._etree.XMLParser(no_network=True))
+                cached = (self._etree.XMLSchema(schema_doc), threading.Lock())
+                _SCHEMA_CACHE[path] = cached
+            return cached
+
+    def validate(self, xml_string: str) -> List[str]:
+        """Devolve a lista de erros estruturais (vazia se o XML for válido)."""
+        try:
+            root = self._etree.fromstring(_strip_xml_declaration(xml_string), self._parser)
+        except self._etree.XMLSyntaxError as e:
+            return [f"XML malformado: {str(e)}"]
+        
+        local_name = self._etree.QName(root).localname
+        file_name = self.SCHEMA_FILES.get(local_name)
+        if file_name is None:
+            return [f"Elemento raiz '{local_name}' não corresponde a um documento NF-e"]
+        
+        schema, lock = self._load_schema(file_name)
+        # O log de erros pertence ao objeto do schema, por isso a validação é serializada
+        with lock:
+            if schema.validate(root):
+                return []
+            return [f"linha {error.line}: {error.message}" for error in list(schema.error_log)[:self.max_errors]]
+
+_DSIG_NS = "http://www.w3.org/2000/09/xmldsig#"
+
+# Certificados já decodificados neste processo, indexados pelo fingerprint SHA-256 do DER
+_CERTIFICATE_CACHE: Dict[str, object] = {}
+_CERTIFICATE_CACHE_LOCK = threading.Lock()
+
+class NFeSignatureVerifier:
+    """Verifica a assinatura digital (XMLDSig) da NF-e sobre o XML original.
+    
+    O documento deve ter exatamente um infNFe, coberto por uma assinatura com
+    uma única referência para o seu Id; o certificado dessa assinatura precisa
+    pertencer ao emitente (mesma raiz de CNPJ, ou mesmo CPF) e estar válido na
+    data de emissão.
+    
+    Os certificados do emitente são decodificados uma única vez por processo e
+    reaproveitados pelo fingerprint. Se `trusted_certs` for informado (arquivos
+    PEM com as ACs confiáveis), a cadeia do certificado também é verificada.
+    """
+    C14N_METHODS = {
+        "http://www.w3.org/TR/2001/REC-xml-c14n-20010315": (False, False),
+        "http://www.w3.org/TR/2001/REC-xml-c14n-20010315#WithComments": (False, True),
+        "http://www.w3.org/2001/10/xml-exc-c14n#": (True, False),
+        "http://www.w3.org/2001/10/xml-exc-c14n#WithComments": (True, True),
+    }
+    DIGEST_METHODS = {
+        "http://www.w3.org/2000/09/xmldsig#sha1": "sha1",
+        "http://www.w3.org/2001/04/xmlenc#sha256": "sha256",
+    }
+    SIGNATURE_METHODS = {
+        "http://www.w3.org/2000/09/xmldsig#rsa-sha1": "sha1",
+        "http://www.w3.org/2001/04/xmldsig-more#rsa-sha256": "sha256",
+    }
+    ENVELOPED_TRANSFORM = "http://www.w3.org/2000/09/xmldsig#enveloped-signature"
+    # Campos otherName dos certificados ICP-Brasil (e-CNPJ e e-CPF)
+    ICP_CNPJ_OID = "2.16.76.1.3.3"
+    ICP_CPF_OID = "2.16.76.1.3.1"
+
+    def __init__(self, trusted_certs: Optional[List[str]] = None, max_chain_depth: int = 5):
+        try:
+            from lxml import etree
+            from cryptography import x509
+            from cryptography.exceptions import InvalidSignature
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.asymmetric import padding
+        except ImportError:
+            raise RuntimeError("A verificação de assinaturas requer os pacotes lxml e cryptography (pip install lxml cryptography)")
+        self._etree = etree
+        self._x509 = x509
+        self._invalid_signature = InvalidSignature
+        self._hashes = {"sha1": hashes.SHA1, "sha256": hashes.SHA256}
+        self._padding = padding
+        self._parser = etree.XMLParser(no_network=True, resolve_entities=False)
+        
+        self.trusted_certs = list(trusted_certs or [])
+        self.max_chain_depth = max_chain_depth
+        self._anchors = []
+        for path in self.trusted_certs:
+            with open(path, 'rb') as f:
+                self._anchors.extend(x509.load_pem_x509_certificates(f.read()))
+        self._chain_results: Dict[str, Optional[str]] = {}
+        self._chain_lock = threading.Lock()
+
+    def _ds(self, tag: str) -> str:
+        return f"{{{_DSIG_NS}}}{tag}"
+
+    def _load_certificate(self, der: bytes):
+        fingerprint = hashlib.sha256(der).hexdigest()
+        with _CERTIFICATE_CACHE_LOCK:
+            certificate = _CERTIFICATE_CACHE.get(fingerprint)
+            if certificate is None:
+                certificate = self._x509.load_der_x509_certificate(der)
+                _CERTIFICATE_CACHE[fingerprint] = certificate
+        return fingerprint, certificate
+
+    def _check_chain(self, fingerprint: str, certificate) -> Optional[str]:
+        """Valida a cadeia até uma AC confiável; o resultado fica em cache pelo fingerprint."""
+        with self._chain_lock:
+            if fingerprint in self._chain_results:
+                return self._chain_results[fingerprint]
+        
+        error = "Cadeia do certificado do emitente não é confiável"
+        current = certificate
+        for _ in range(self.max_chain_depth):
+            issuer = None
+            for anchor in self._anchors:
+                if anchor.subject != current.issuer:
+                    continue
+                try:
+                    current.verify_directly_issued_by(anchor)
+                except Exception:
+                    continue
+                issuer = anchor
+                break
+            if issuer is None:
+                break
+            if issuer.subject == issuer.issuer:
+                error = None
+                break
+            current = issuer
+        
+        with self._chain_lock:
+            self._chain_results[fingerprint] = error
+        return error
+
+    @staticmethod
+    def _der_payload(value: bytes) -> bytes:
+        """Conteúdo de um único TLV DER (o otherName traz a string ainda codificada)."""
+        if len(value) < 2:
+            return b''
+        length, start = value[1], 2
+        if length & 0x80:
+            size = length & 0x7F
+            length, start = int.from_bytes(value[2:2 + size], 'big'), 2 + size
+        return value[start:start + length]
+
+    def _certificate_holder(self, certificate) -> Tuple[str, str]:
+        """Devolve (CNPJ, CPF) do titular do certificado, pelo otherName ICP-Brasil ou pelo CN."""
+        cnpj = cpf = ''
+        try:
+            san = certificate.extensions.get_extension_for_class(self._x509.SubjectAlternativeName).value
+            for other in san.get_values_for_type(self._x509.OtherName):
+                text = self._der_payload(other.value).decode('latin-1')
+                if other.type_id.dotted_string == self.ICP_CNPJ_OID:
+                    match = re.search(r'[0-9A-Z]{12}\d{2}', text)
+                    cnpj = match.group(0) if match else cnpj
+                elif other.type_id.dotted_string == self.ICP_CPF_OID:
+                    # Data de nascimento (8 dígitos) seguida do CPF (11 dígitos)
+                    cpf = text[8:19] if re.fullmatch(r'\d{11}', text[8:19]) else cpf
+        except self._x509.ExtensionNotFound:
+            pass
+        if not cnpj and not cpf:
+            for attribute in certificate.subject.get_attributes_for_oid(self._x509.NameOID.COMMON_NAME):
+                match = re.search(r':([0-9A-Z]{12}\d{2}|\d{11})$', attribute.value)
+                if match:
+                    if len(match.group(1)) == 14:
+                        cnpj = match.group(1)
+                    else:
+                        cpf = match.group(1)
+        return cnpj, cpf
+
+    def _holder_errors(self, certificate, inf_nfe) -> List[str]:
+        """Confere se o certificado pertence ao emitente e estava válido na emissão."""
+        errors = []
+        emit_cnpj = ''.join(inf_nfe.xpath('./*[local-name()="emit"]/*[local-name()="CNPJ"]/text()')).strip().upper()
+        emit_cpf = ''.join(inf_nfe.xpath('./*[local-name()="emit"]/*[local-name()="CPF"]/text()')).strip()
+        cert_cnpj, cert_cpf = self._certificate_holder(certificate)
+        if emit_cnpj:
+            # A SEFAZ aceita o certificado de qualquer estabelecimento da mesma empresa (raiz do CNPJ)
+            if not cert_cnpj:
+                errors.append("Certificado da assinatura não identifica um CNPJ")
+            elif cert_cnpj[:8] != emit_cnpj[:8]:
+                errors.append(f"Certificado da assinatura pertence ao CNPJ {cert_cnpj}, não ao emitente {emit_cnpj}")
+        elif emit_cpf and cert_cpf != emit_cpf:
+            errors.append(f"Certificado da assinatura não pertence ao CPF do emitente {emit_cpf}")
+        
+        issued_at = datetime.now(timezone.utc)
+        dh_emi = ''.join(inf_nfe.xpath('./*[local-name()="ide"]/*[local-name()="dhEmi"]/text()')).strip()
+        if dh_emi:
+            try:
+                issued_at = datetime.fromisoformat(dh_emi)
+                if issued_at.tzinfo is None:
+                    issued_at = issued_at.replace(tzinfo=timezone.utc)
+            except ValueError:
+                pass
+        if not certificate.not_valid_before_utc <= issued_at <= certificate.not_valid_after_utc:
+            errors.append(f"Certificado da assinatura fora do prazo de validade em {issued_at.isoformat()}")
+        return errors
+
+    def _canonicalize(self, element, algorithm: str) -> bytes:
+        if algorithm not in self.C14N_METHODS:
+            raise ValueError(f"Método de canonicalização não suportado: {algorithm}")
+        exclusive, with_comments = self.C14N_METHODS[algorithm]
+        return self._etree.tostring(element, method='c14n', exclusive=exclusive, with_comments=with_comments)
+
+    def _reference_errors(self, root, signature, reference) -> List[str]:
+        uri = reference.get('URI', '')
+        if uri.startswith('#'):
+            targets = root.xpath('//*[@Id=$id]', id=uri[1:])
+            if len(targets) != 1:
+                return [f"Elemento referenciado pela assinatura não encontrado: {uri}"]
+            target = targets[0]
+        elif uri == '':
+            target = root
+        else:
+            return [f"Referência externa não suportada: {uri}"]
+        
+        transforms = [t.get('Algorithm') for t in reference.findall(f"{self._ds('Transforms')}/{self._ds('Transform')}")]
+        c14n_algorithm = "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"
+        for algorithm in transforms:
+            if algorithm in self.C14N_METHODS:
+                c14n_algorithm = algorithm
+        if self.ENVELOPED_TRANSFORM in transforms and signature in target.iter(self._ds('Signature')):
+            # Remove a própria assinatura de uma cópia do elemento assinado
+            target = copy.deepcopy(target)
+            for enveloped in list(target.iter(self._ds('Signature'))):
+                enveloped.getparent().remove(enveloped)
+        
+        digest_method = reference.find(self._ds('DigestMethod')).get('Algorithm')
+        if digest_method not in self.DIGEST_METHODS:
+            return [f"Algoritmo de digest não suportado: {digest_method}"]
+        digest = hashlib.new(self.DIGEST_METHODS[digest_method], self._canonicalize(target, c14n_algorithm)).digest()
+        expected = base64.b64decode(reference.findtext(self._ds('DigestValue')) or '')
+        if digest != expected:
+            return [f"Digest da referência {uri or 'documento'} não confere (conteúdo alterado após a assinatura)"]
+        return []
+
+    def _signature_errors(self, root, signature, inf_nfe=None) -> List[str]:
+        """Erros de uma assinatura; `inf_nfe` é informado quando ela é a assinatura da nota."""
+        signed_info = signature.find(self._ds('SignedInfo'))
+        errors = []
+        for reference in signed_info.findall(self._ds('Reference')):
+            errors.extend(self._reference_errors(root, signature, reference))
+        
+        cert_text = signature.findtext(f".//{self._ds('X509Certificate')}")
+        if not cert_text:
+            return errors + ["Certificado do emitente ausente na assinatura"]
+        fingerprint, certificate = self._load_certificate(base64.b64decode(cert_text))
+        
+        signature_method = signed_info.find(self._ds('SignatureMethod')).get('Algorithm')
+        if signature_method not in self.SIGNATURE_METHODS:
+            return errors + [f"Algoritmo de assinatura não suportado: {signature_method}"]
+        if inf_nfe is not None:
+            errors.extend(self._holder_errors(certificate, inf_nfe))
+        c14n_method = signed_info.find(self._ds('CanonicalizationMethod')).get('Algorithm')
+        try:
+            certificate.public_key().verify(
+                base64.b64decode(signature.findtext(self._ds('SignatureValue')) or ''),
+                self._canonicalize(signed_info, c14n_method),
+                self._padding.PKCS1v15(),
+                self._hashes[self.SIGNATURE_METHODS[signature_method]]()
+            )
+        except self._invalid_signature:
+            errors.append("Valor da assinatura não confere com o certificado do emitente")
+        
+        if self._anchors:
+            chain_error = self._check_chain(fingerprint, certificate)
+            if chain_error:
+                errors.append(chain_error)
+        return errors
+
+    def verify(self, xml_data: Union[str, bytes]) -> List[str]:
+        """Devolve a lista de erros de assinatura (vazia se a assinatura for válida)."""
+        try:
+            if isinstance(xml_data, str):
+                xml_data = _strip_xml_declaration(xml_data)
+            root = self._etree.fromstring(xml_data, self._parser)
+        except self._etree.XMLSyntaxError as e:
+            return [f"XML malformado: {str(e)}"]
+        
+        # Um segundo infNFe (não assinado) é o caminho clássico para "signature wrapping"
+        inf_nodes = root.xpath('//*[local-name()="infNFe"]')
+        if len(inf_nodes) != 1:
+            return [f"O documento deve conter exatamente um infNFe (encontrados {len(inf_nodes)})"]
+        inf_nfe = inf_nodes[0]
+        inf_uri = '#' + inf_nfe.get('Id', '')
+        
+        signatures = list(root.iter(self._ds('Signature')))
+        if not signatures:
+            return ["Assinatura digital ausente"]
+        errors = []
+        covering = 0
+        for signature in signatures:
+            try:
+                references = signature.findall(f"{self._ds('SignedInfo')}/{self._ds('Reference')}")
+                if len(references) != 1:
+                    errors.append(f"A assinatura deve ter exatamente uma referência (encontradas {len(references)})")
+                    continue
+                is_nfe_signature = references[0].get('URI') == inf_uri
+                covering += is_nfe_signature
+                errors.extend(self._signature_errors(root, signature, inf_nfe if is_nfe_signature else None))
+            except Exception as e:
+                errors.append(f"Assinatura digital malformada: {str(e)}")
+        if covering != 1:
+            errors.append(f"O infNFe {inf_nfe.get('Id', '')} deve ser coberto por exatamente uma assinatura (encontradas {covering})")
+        return errors
+
+    def verify_files(self, file_paths: List[str], workers: Optional[int] = None) -> Dict[str, List[str]]:
+        """Verifica as assinaturas de vários arquivos em paralelo, em processos separados."""
+        if workers == 1 or len(file_paths) < 2:
+            return dict(_verify_signature_file(path, self) for path in file_paths)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_signature_worker,
+                                 initargs=(self.trusted_certs,)) as executor:
+            chunksize = max(1, len(file_paths) // ((workers or os.cpu_count() or 1) * 4))
+            return dict(executor.map(_verify_signature_file, file_paths, chunksize=chunksize))
+
+# Verificador de cada processo do pool de verificação de assinaturas
+_PROCESS_SIGNATURE_VERIFIER: Optional[NFeSignatureVerifier] = None
+
+def _init_signature_worker(trusted_certs: List[str]):
+    global _PROCESS_SIGNATURE_VERIFIER
+    _PROCESS_SIGNATURE_VERIFIER = NFeSignatureVerifier(trusted_certs)
+
+def _verify_signature_file(file_path: str, verifier: Optional[NFeSignatureVerifier] = None) -> Tuple[str, List[str]]:
+    """Lê os bytes originais do arquivo e verifica a assinatura."""
+    verifier = verifier or _PROCESS_SIGNATURE_VERIFIER
+    try:
+        with open(file_path, 'rb') as f:
+            return file_path, verifier.verify(f.read())
+    except Exception as e:
+        return file_path, [f"Erro ao verificar assinatura: {str(e)}"]
+
+class FiscalCodeValidator:
+    """Validação em lote de identificadores fiscais: CNPJ, CPF, chave de acesso, NCM e CFOP.
+    
+    Os dígitos verificadores são calculados com tabelas de pesos pré-computadas
+    sobre os bytes ASCII de cada identificador (valor = código ASCII - 48, o que
+    também cobre o CNPJ alfanumérico), e os códigos NCM/CFOP são conferidos por
+    consulta a conjuntos. Sem tabelas oficiais, NCM e CFOP são validados pela
+    estrutura (capítulo do NCM e primeiro dígito do CFOP).
+    """
+    _CNPJ_WEIGHTS_1 = (5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+    _CNPJ_WEIGHTS_2 = (6,) + _CNPJ_WEIGHTS_1
+    _CPF_WEIGHTS_1 = tuple(range(10, 1, -1))
+    _CPF_WEIGHTS_2 = tuple(range(11, 1, -1))
+    # Pesos de 2 a 9, da direita para a esquerda, sobre as 43 primeiras posições
+    _CHAVE_WEIGHTS = tuple(reversed([2 + (i % 8) for i in range(43)]))
+    
+    CFOP_FIRST_DIGITS = frozenset(b'123567')
+    NCM_CHAPTERS = frozenset(f"{n:02d}" for n in range(1, 98) if n != 77)
+
+    def __init__(self, ncm_codes: Optional[set] = None, cfop_codes: Optional[set] = None):
+        self.ncm_codes = frozenset(ncm_codes) if ncm_codes is not None else None
+        self.cfop_codes = frozenset(cfop_codes) if cfop_codes is not None else None
+
+    @staticmethod
+    def load_code_table(file_path: str) -> set:
+        """Carrega uma tabela de códigos (primeira coluna de um CSV, pontuação ignorada)."""
+        codes = set()
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                code = re.sub(r'\D', '', line.split(',')[0].split(';')[0])
+                if code:
+                    codes.add(code)
+        return codes
+
+    @staticmethod
+    def _check_digits(values: List[str], length: int, weights: Tuple[Tuple[int, ...], ...]) -> List[bool]:
+        """Confere os dígitos verificadores (módulo 11) de uma lista de identificadores."""
+        # sum(w * (c - 48)) == sum(w * c) - 48 * sum(w): a subtração fica pré-computada
+        checks = [(w, 48 * sum(w), length - len(weights) + n) for n, w in enumerate(weights)]
+        body_length = length - len(weights)
+        # Num lote os mesmos CNPJs se repetem muito: cada valor distinto é calculado uma única vez
+        known: Dict[str, bool] = {}
+        results = []
+        for value in values:
+            cached = known.get(value)
+            if cached is not None:
+                results.append(cached)
+                continue
+            code = value.encode('ascii', 'replace')
+            valid = (
+                len(code) == length
+                and code[body_length:].isdigit()
+                and code[:body_length].isalnum()
+                and code[:body_length] == code[:body_length].upper()
+                and code.count(code[:1]) != length
+            )
+            if valid:
+                for w, offset, position in checks:
+                    remainder = (sum(map(mul, w, code)) - offset) % 11
+                    if code[position] - 48 != (0 if remainder < 2 else 11 - remainder):
+                        valid = False
+                        break
+            known[value] = valid
+            results.append(valid)
+        return results
+
+    def validate_cnpjs(self, values: List[str]) -> List[bool]:
+        return self._check_digits(values, 14, (self._CNPJ_WEIGHTS_1, self._CNPJ_WEIGHTS_2))
+
+    def validate_cpfs(self, values: List[str]) -> List[bool]:
+        return [valid and value.isdigit() for valid, value in
+                zip(self._check_digits(values, 11, (self._CPF_WEIGHTS_1, self._CPF_WEIGHTS_2)), values)]
+
+    def validate_access_keys(self, values: List[str]) -> List[bool]:
+        return self._check_digits(values, 44, (self._CHAVE_WEIGHTS,))
+
+    def validate_ncms(self, values: List[str]) -> List[bool]:
+        if self.ncm_codes is not None:
+            return [value in self.ncm_codes for value in values]
+        chapters = self.NCM_CHAPTERS
+        return [len(value) == 8 and value.isdigit() and value[:2] in chapters for value in values]
+
+    def validate_cfops(self, values: List[str]) -> List[bool]:
+        if self.cfop_codes is not None:
+            return [value in self.cfop_codes for value in values]
+        first_digits = self.CFOP_FIRST_DIGITS
+        return [len(value) == 4 and value.isdigit() and ord(value[0]) in first_digits for value in values]
+
+    def validate_invoices(self, invoices: List[Dict]) -> List[List[str]]:
+        """Valida os identificadores de várias notas de uma vez; devolve os problemas de cada nota."""
+        columns: Dict[str, Tuple[List[str], List[Tuple[int, str]]]] = {
+            kind: ([], []) for kind in ('cnpj', 'cpf', 'chave', 'ncm', 'cfop')
+        }
+        
+        def add(kind: str, value: str, index: int, message: str):
+            columns[kind][0].append(value)
+            columns[kind][1].append((index, message))
+        
+        for index, invoice in enumerate(invoices):
+            for role, label in (('emitente', 'emitente'), ('destinatario', 'destinatário')):
+                party = invoice.get(role, {})
+                if party.get('cnpj'):
+                    add('cnpj', party['cnpj'], index, f"CNPJ do {label} inválido: {party['cnpj']}")
+                elif party.get('cpf'):
+                    add('cpf', party['cpf'], index, f"CPF do {label} inválido: {party['cpf']}")
+            if invoice.get('chave_acesso'):
+                add('chave', invoice['chave_acesso'], index, f"Chave de acesso inválida: {invoice['chave_acesso']}")
+            for produto in invoice.get('produtos', []):
+                if produto.get('ncm'):
+                    add('ncm', produto['ncm'], index, f"NCM inválido no produto {produto.get('codigo', '')}: {produto['ncm']}")
+                if produto.get('cfop'):
+                    add('cfop', produto['cfop'], index, f"CFOP inválido no produto {produto.get('codigo', '')}: {produto['cfop']}")
+        
+        validators = {
+            'cnpj': self.validate_cnpjs,
+            'cpf': self.validate_cpfs,
+            'chave': self.validate_access_keys,
+            'ncm': self.validate_ncms,
+            'cfop': self.validate_cfops,
+        }
+        results: List[List[str]] = [[] for _ in invoices]
+        for kind, (values, owners) in columns.items():
+            if not values:
+                continue
+            for valid, (index, message) in zip(validators[kind](values), owners):
+                if not valid:
+                    results[index].append(message)
+        return results
+
+class PurchaseOrderMatcher:
+    """Confronta os itens das notas com os pedidos de compra (CSV ou SQLite).
+    
+    As linhas de pedido ficam em um índice hash por (CNPJ do fornecedor, número
+    do pedido, código do produto); linhas repetidas do mesmo produto no pedido
+    somam suas quantidades. As notas de um lote são cruzadas com o índice de uma
+    só vez, e a quantidade faturada por produto do pedido é acumulada entre
+    chamadas, então o excesso é detectado também quando as notas chegam uma a
+    uma. Com `state_path` (SQLite) esse acumulado é compartilhado entre
+    processos e execuções. Notas já contadas (pela chave de acesso) não somam
+    de novo. Itens cujo código não aparece no pedido são procurados pela
+    descrição (similaridade mínima `description_threshold`).
+    """
+    COLUMNS = ('cnpj_fornecedor', 'numero_pedido', 'codigo', 'descricao', 'quantidade', 'valor_unitario')
+
+    def __init__(self, price_tolerance: float = 0.01, quantity_tolerance: float = 0.0,
+                 description_threshold: float = 0.8, state_path: Optional[str] = None):
+        self.price_tolerance = price_tolerance
+        self.quantity_tolerance = quantity_tolerance
+        self.description_threshold = description_threshold
+        self._index: Dict[Tuple[str, str, str], List[Dict]] = {}
+        self._orders: Dict[Tuple[str, str], List[Dict]] = {}
+        
+        self._invoiced: Dict[Tuple[str, str, str], float] = {}
+        self._counted: set = set()
+        self._lock = threading.Lock()
+        self._conn = None
+        if state_path:
+            self._conn = sqlite3.connect(state_path, timeout=30.0, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS po_invoiced (
+                    cnpj_fornecedor TEXT NOT NULL,
+                    numero_pedido TEXT NOT NULL,
+                    codigo TEXT NOT NULL,
+                    quantidade REAL NOT NULL,
+                    PRIMARY KEY (cnpj_fornecedor, numero_pedido, codigo)
+                )
+            """)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS po_counted_invoices (chave_acesso TEXT PRIMARY KEY)")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def _normalize_id(value) -> str:
+        return re.sub(r'[^0-9A-Za-z]', '', str(value or '')).upper()
+
+    @staticmethod
+    def _normalize_text(value) -> str:
+        text = unicodedata.normalize('NFKD', str(value or '')).encode('ascii', 'ignore').decode('ascii')
+        return ' '.join(text.lower().split())
+
+    @staticmethod
+    def _parse_number(value) -> float:
+        text = str(value).strip()
+        if ',' in text:
+            # Formato brasileiro: 1.234,56
+            text = text.replace('.', '').replace(',', '.')
+        return float(text or 0)
+
+    def add_lines(self, lines: List[Dict]):
+        """Adiciona linhas de pedido ao índice."""
+        for line in lines:
+            entry = {
+                'cnpj_fornecedor': self._normalize_id(line['cnpj_fornecedor']),
+                'numero_pedido': str(line['numero_pedido']).strip(),
+                'codigo': str(line['codigo']).strip(),
+                'descricao': str(line.get('descricao') or ''),
+                'descricao_normalizada': self._normalize_text(line.get('descricao')),
+                'quantidade': self._parse_number(line['quantidade']),
+                'valor_unitario': self._parse_number(line['valor_unitario']),
+            }
+            order_key = (entry['cnpj_fornecedor'], entry['numero_pedido'])
+            self._index.setdefault(order_key + (entry['codigo'],), []).append(entry)
+            self._orders.setdefault(order_key, []).append(entry)
+
+    @classmethod
+    def from_csv(cls, file_path: str, **kwargs) -> 'PurchaseOrderMatcher':
+        matcher = cls(**kwargs)
+        with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
+            header = f.readline()
+            f.seek(0)
+            delimiter = ';' if header.count(';') > header.count(',') else ','
+            matcher.add_lines(list(csv.DictReader(f, delimiter=delimiter)))
+        return matcher
+
+    @classmethod
+    def from_sqlite(cls, db_path: str, table: str = 'pedidos', **kwargs) -> 'PurchaseOrderMatcher':
+        if not re.match(r'^\w+$', table):
+            raise ValueError(f"Nome de tabela inválido: {table}")
+        matcher = cls(**kwargs)
+        with sqlite3.connect(db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f"SELECT {', '.join(cls.COLUMNS)} FROM {table}").fetchall()
+        matcher.add_lines([dict(row) for row in rows])
+        return matcher
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> 'PurchaseOrderMatcher':
+        """Carrega de um banco SQLite (.db, .sqlite, .sqlite3) ou de um CSV."""
+        if path.lower().endswith(('.db', '.sqlite', '.sqlite3')):
+            return cls.from_sqlite(path, **kwargs)
+        return cls.from_csv(path, **kwargs)
+
+    def _fuzzy_match(self, order_key: Tuple[str, str], descricao: str) -> Optional[Dict]:
+        target = self._normalize_text(descricao)
+        best, best_ratio = None, self.description_threshold
+        for line in self._orders.get(order_key, []):
+            ratio = difflib.SequenceMatcher(None, target, line['descricao_normalizada']).ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = line, ratio
+        return best
+
+    def _already_counted(self, chave: str) -> bool:
+        if self._conn is None:
+            return chave in self._counted
+        return self._conn.execute("SELECT 1 FROM po_counted_invoices WHERE chave_acesso = ?", (chave,)).fetchone() is not None
+
+    def _previously_invoiced(self, line_key: Tuple[str, str, str]) -> float:
+        if self._conn is None:
+            return self._invoiced.get(line_key, 0.0)
+        row = self._conn.execute(
+            "SELECT quantidade FROM po_invoiced WHERE cnpj_fornecedor = ? AND numero_pedido = ? AND codigo = ?", line_key
+        ).fetchone()
+        return row[0] if row else 0.0
+
+    def _record(self, deltas: Dict[Tuple[str, str, str], float], chaves: List[str]):
+        if self._conn is None:
+            for line_key, quantidade in deltas.items():
+                self._invoiced[line_key] = self._invoiced.get(line_key, 0.0) + quantidade
+            self._counted.update(chaves)
+            return
+        self._conn.executemany(
+            "INSERT INTO po_invoiced (cnpj_fornecedor, numero_pedido, codigo, quantidade) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (cnpj_fornecedor, numero_pedido, codigo) DO UPDATE SET quantidade = quantidade + excluded.quantidade",
+            [line_key + (quantidade,) for line_key, quantidade in deltas.items()]
+        )
+        self._conn.executemany("INSERT OR IGNORE INTO po_counted_invoices (chave_acesso) VALUES (?)",
+                               [(chave,) for chave in chaves])
+
+    def match_invoices(self, invoices: List[Dict]) -> List[List[str]]:
+        """Cruza todas as notas com o índice de pedidos; devolve os problemas de cada nota."""
+        with self._lock:
+            if self._conn is None:
+                return self._match(invoices)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                results = self._match(invoices)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return results
+
+    def _match(self, invoices: List[Dict]) -> List[List[str]]:
+        results: List[List[str]] = [[] for _ in invoices]
+        deltas: Dict[Tuple[str, str, str], float] = {}
+        owners: Dict[Tuple[str, str, str], List[int]] = {}
+        seen_in_batch = set()
+        new_chaves = []
+        
+        for index, invoice in enumerate(invoices):
+            cnpj = self._normalize_id(invoice.get('emitente', {}).get('cnpj'))
+            chave = invoice.get('chave_acesso', '')
+            # Notas sem chave de acesso não têm como ser reconhecidas depois, então sempre somam
+            counted = not chave or (chave not in seen_in_batch and not self._already_counted(chave))
+            if chave:
+                seen_in_batch.add(chave)
+                if counted:
+                    new_chaves.append(chave)
+            
+            missing_orders = set()
+            for produto in invoice.get('produtos', []):
+                numero_pedido = str(produto.get('pedido') or invoice.get('pedido_compra') or '').strip()
+                codigo = produto.get('codigo', '')
+                if not numero_pedido:
+                    results[index].append(f"Produto {codigo} sem referência a pedido de compra")
+                    continue
+                order_key = (cnpj, numero_pedido)
+                if order_key not in self._orders:
+                    missing_orders.add(numero_pedido)
+                    continue
+                
+                lines = self._index.get(order_key + (codigo,))
+                if lines is None:
+                    fuzzy = self._fuzzy_match(order_key, produto.get('descricao', ''))
+                    if fuzzy is None:
+                        results[index].append(f"Produto {codigo} não consta no pedido {numero_pedido}")
+                        continue
+                    lines = self._index[order_key + (fuzzy['codigo'],)]
+                
+                # Com linhas repetidas do produto, o preço é conferido contra a mais próxima
+                valor_unitario = produto.get('valor_unitario', 0)
+                line = min(lines, key=lambda candidate: abs(valor_unitario - candidate['valor_unitario']))
+                preco_pedido = line['valor_unitario']
+                if abs(valor_unitario - preco_pedido) > self.price_tolerance * max(preco_pedido, 0.01):
+                    results[index].append(
+                        f"Preço do produto {codigo} diverge do pedido {numero_pedido}: "
+                        f"nota {valor_unitario:.2f}, pedido {preco_pedido:.2f}"
+                    )
+                line_key = order_key + (line['codigo'],)
+                if counted:
+                    deltas[line_key] = deltas.get(line_key, 0.0) + produto.get('quantidade', 0)
+                owners.setdefault(line_key, []).append(index)
+            
+            for numero_pedido in sorted(missing_orders):
+                results[index].append(f"Pedido de compra {numero_pedido} não encontrado para o fornecedor")
+        
+        # Quantidade faturada acumulada (notas anteriores mais este lote) contra a quantidade do pedido
+        for line_key, indexes in owners.items():
+            quantidade = self._previously_invoiced(line_key) + deltas.get(line_key, 0.0)
+            lines = self._index[line_key]
+            pedida = sum(line['quantidade'] for line in lines)
+            if quantidade > pedida * (1 + self.quantity_tolerance) + 1e-9:
+                message = (
+                    f"Quantidade faturada do produto {line_key[2]} ({quantidade:g}) excede "
+                    f"o pedido {line_key[1]} ({pedida:g})"
+                )
+                for index in sorted(set(indexes)):
+                    results[index].append(message)
+        
+        self._record(deltas, new_chaves)
+        return results
+
+class _P2Quantile:
+    """Estimador de quantil em fluxo (algoritmo P², Jain & Chlamtac): memória constante de 5 marcadores."""
+    def __init__(self, p: float, state: Optional[Dict] = None):
+        self.p = p
+        if state:
+            self.q, self.n, self.np = state['q'], state['n'], state['np']
+        else:
+            self.q: List[float] = []
+            self.n: List[int] = []
+            self.np: List[float] = []
+        self.dn = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def to_state(self) -> Dict:
+        return {'q': self.q, 'n': self.n, 'np': self.np}
+
+    def add(self, x: float):
+        q, n = self.q, self.n
+        if len(n) < 5:
+            bisect.insort(q, x)
+            if len(q) == 5:
+                self.n = [0, 1, 2, 3, 4]
+                self.np = [0, 2 * self.p, 4 * self.p, 2 + 2 * self.p, 4]
+            return
+        
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(q, x) - 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+        
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Ajuste parabólico; se sair do intervalo, usa o linear
+                qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self) -> Optional[float]:
+        if not self.q:
+            return None
+        if len(self.n) < 5:
+            return self.q[min(len(self.q) - 1, int(self.p * len(self.q)))]
+        return self.q[2]
+
+class PriceHistory:
+    """Histórico persistente de preços por (CNPJ do fornecedor, código do produto).
+    
+    Cada par guarda apenas contagem, média e variância (Welford) e um estimador
+    P² do percentil `quantile`, então pontuar um item é O(1) e o tamanho por
+    par não cresce com o histórico. Os pares ficam em SQLite; em memória há no
+    máximo `max_keys` deles (LRU). Notas já vistas (pela chave de acesso) não
+    alimentam o histórico de novo, o que permite reauditar sem distorcê-lo.
+    Preços apontados como atípicos também ficam fora do histórico, para que um
+    sobrepreço repetido não vá se tornando normal; em compensação, um reajuste
+    legítimo acima do limite continua apontado até que o par seja zerado com
+    `reset`, quando o histórico recomeça a partir das próximas notas.
+    
+    Com `shared=True` (vários processos no mesmo banco) cada nota é pontuada e
+    gravada numa transação própria, sem cache entre notas.
+    """
+    def __init__(self, db_path: str, min_history: int = 10, z_threshold: float = 3.0,
+                 quantile: float = 0.95, max_keys: int = 10000, min_relative_std: float = 0.01,
+                 flush_every: int = 100, shared: bool = False):
+        self.min_history = min_history
+        self.z_threshold = z_threshold
+        self.quantile = quantile
+        self.max_keys = max_keys
+        self.min_relative_std = min_relative_std
+        self.flush_every = flush_every
+        self.shared = shared
+        
+        self._lock = threading.Lock()
+        self._cache: 'OrderedDict[Tuple[str, str], Dict]' = OrderedDict()
+        self._dirty: Dict[Tuple[str, str], Dict] = {}
+        self._seen_pending: List[str] = []
+        self._updates_since_flush = 0
+        self._conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS price_stats (
+                cnpj TEXT NOT NULL,
+                codigo TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                quantile_state TEXT NOT NULL,
+                PRIMARY KEY (cnpj, codigo)
+            )
+        """)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS seen_invoices (chave_acesso TEXT PRIMARY KEY)")
+
+    def _get(self, key: Tuple[str, str]) -> Dict:
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            return entry
+        
+        # Entradas despejadas do cache mas ainda não gravadas continuam valendo
+        entry = self._dirty.get(key)
+        if entry is not None:
+            self._cache[key] = entry
+            return entry
+        
+        row = self._conn.execute(
+            "SELECT count, mean, m2, quantile_state FROM price_stats WHERE cnpj = ? AND codigo = ?", key
+        ).fetchone()
+        if row:
+            entry = {'count': row[0], 'mean': row[1], 'm2': row[2],
+                     'quantile': _P2Quantile(self.quantile, json.loads(row[3]))}
+        else:
+            entry = {'count': 0, 'mean': 0.0, 'm2': 0.0, 'quantile': _P2Quantile(self.quantile)}
+        self._cache[key] = entry
+        return entry
+
+    def _write(self, key: Tuple[str, str], entry: Dict):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO price_stats (cnpj, codigo, count, mean, m2, quantile_state) VALUES (?, ?, ?, ?, ?, ?)",
+            key + (entry['count'], entry['mean'], entry['m2'], json.dumps(entry['quantile'].to_state()))
+        )
+
+    def _score(self, entry: Dict, value: float) -> Optional[Tuple[float, float]]:
+        """Devolve (z-score, percentil) se o preço for atípico para o histórico."""
+        if entry['count'] < self.min_history:
+            return None
+        mean = entry['mean']
+        std = (entry['m2'] / (entry['count'] - 1)) ** 0.5
+        std = max(std, abs(mean) * self.min_relative_std, 1e-9)
+        z = (value - mean) / std
+        upper = entry['quantile'].value()
+        if z > self.z_threshold and value > upper:
+            return z, upper
+        return None
+
+    def _update(self, key: Tuple[str, str], entry: Dict, value: float):
+        entry['count'] += 1
+        delta = value - entry['mean']
+        entry['mean'] += delta / entry['count']
+        entry['m2'] += delta * (value - entry['mean'])
+        entry['quantile'].add(value)
+        self._dirty[key] = entry
+
+    def check_invoice(self, invoice: Dict) -> List[str]:
+        """Pontua os itens da nota contra o histórico e, se a nota for nova, atualiza o histórico."""
+        cnpj = invoice.get('emitente', {}).get('cnpj', '')
+        chave = invoice.get('chave_acesso', '')
+        with self._lock:
+            if not self.shared:
+                issues = self._check_items(invoice, cnpj, chave)
+                if self._updates_since_flush >= self.flush_every:
+                    self._flush()
+            else:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._cache.clear()
+                try:
+                    issues = self._check_items(invoice, cnpj, chave)
+                    self._write_pending()
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    self._dirty.clear()
+                    self._seen_pending = []
+                    raise
+                self._conn.execute("COMMIT")
+            while len(self._cache) > self.max_keys:
+                self._cache.popitem(last=False)
+        return issues
+
+    def _check_items(self, invoice: Dict, cnpj: str, chave: str) -> List[str]:
+        issues = []
+        already_seen = bool(chave) and (
+            chave in self._seen_pending or
+            self._conn.execute("SELECT 1 FROM seen_invoices WHERE chave_acesso = ?", (chave,)).fetchone() is not None
+        )
+        for produto in invoice.get('produtos', []):
+            codigo = produto.get('codigo', '')
+            valor = produto.get('valor_unitario', 0.0)
+            if not cnpj or not codigo or valor <= 0:
+                continue
+            key = (cnpj, codigo)
+            entry = self._get(key)
+            outlier = self._score(entry, valor)
+            if outlier:
+                z, upper = outlier
+                issues.append(
+                    f"Preço do produto {codigo} acima do histórico do fornecedor: {valor:.2f} "
+                    f"(média {entry['mean']:.2f}, p{int(self.quantile * 100)} {upper:.2f}, z={z:.1f})"
+                )
+            if not already_seen and not outlier:
+                self._update(key, entry, valor)
+        
+        if not already_seen:
+            if chave:
+                self._seen_pending.append(chave)
+            self._updates_since_flush += 1
+        return issues
+
+    def _write_pending(self):
+        for key, entry in self._dirty.items():
+            self._write(key, entry)
+        self._conn.executemany("INSERT OR IGNORE INTO seen_invoices (chave_acesso) VALUES (?)",
+                               [(chave,) for chave in self._seen_pending])
+        self._dirty.clear()
+        self._seen_pending = []
+        self._updates_since_flush = 0
+
+    def _flush(self):
+        if not self._dirty and not self._seen_pending:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._write_pending()
+        self._conn.execute("COMMIT")
+
+    def reset(self, cnpj: str, codigo: str) -> bool:
+        """Descarta o histórico de um par (após um reajuste aceito); devolve False se ele não existia."""
+        key = (cnpj, codigo)
+        with self._lock:
+            self._cache.pop(key, None)
+            pending = self._dirty.pop(key, None) is not None
+            cursor = self._conn.execute("DELETE FROM price_stats WHERE cnpj = ? AND codigo = ?", key)
+            return pending or cursor.rowcount > 0
+
+    def flush(self):
+        """Grava no SQLite as estatísticas ainda pendentes."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
 class InvoiceAuditTool(BaseTool):
     name: str = "invoice_auditor"
     description: str = "Validates and audits invoice data for tax compliance"
+    # Validação opcional contra os XSDs oficiais, feita antes da sanitização
+    schema_validator: Optional[NFeSchemaValidator] = None
+    # Verificação opcional da assinatura digital, também sobre o XML original
+    signature_verifier: Optional[NFeSignatureVerifier] = None
+    # Validação de CNPJ/CPF, chave de acesso, NCM e CFOP
+    fiscal_code_validator: FiscalCodeValidator = FiscalCodeValidator()
+    # Confronto opcional com os pedidos de compra
+    purchase_order_matcher: Optional[PurchaseOrderMatcher] = None
+    # Histórico opcional de preços por fornecedor e produto
+    price_history: Optional[PriceHistory] = None
     
     def _sanitize_xml(self, xml_string: str) -> str:
         """Sanitiza e formata o XML para processamento."""
@@ -114,15 +1146,33 @@ class InvoiceAuditTool(BaseTool):
                 return found.text
         return default
 
-    def _xml_to_dict(self, xml_string: str) -> dict:
-        """Convert XML string to dictionary."""
+    def _xml_to_dict(self, xml_string: str, signature_errors: Optional[List[str]] = None) -> dict:
+        """Convert XML string to dictionary.
+        
+        `signature_errors` receives results already computed in parallel
+        (see NFeSignatureVerifier.verify_files), avoiding a second verification.
+        """
         try:
+            # Initialize data dictionary
+            data = {}
+            
+            # Schema and signature checks need the original namespaces, so they run before sanitizing
+            if self.schema_validator is not None:
+                data['erros_schema'] = self.schema_validator.validate(xml_string)
+            if signature_errors is not None:
+                data['erros_assinatura'] = signature_errors
+            elif self.signature_verifier is not None:
+                data['erros_assinatura'] = self.signature_verifier.verify(xml_string)
+            
             # Sanitize XML before parsing
             xml_string = self._sanitize_xml(xml_string)
-            root = ET.fromstring(xml_string)
+            document = ET.fromstring(xml_string)
             
-            # Initialize data dictionary
-            data = {}
+            # Only the single infNFe (the element the signature covers) is read
+            inf_nodes = list(document.iter('infNFe'))
+            if len(inf_nodes) > 1:
+                raise ValueError(f"XML contém {len(inf_nodes)} elementos infNFe; esperado apenas um")
+            root = inf_nodes[0] if inf_nodes else document
             
             # Extract nota fiscal number (try multiple paths)
             nf_paths = ['.//nNF', './/ide/nNF', './/infNFe//nNF']
@@ -131,6 +1181,15 @@ class InvoiceAuditTool(BaseTool):
             # Extract emission date (try multiple paths)
             date_paths = ['.//dhEmi', './/ide/dhEmi', './/infNFe//dhEmi']
             data['data_emissao'] = self._get_element_text(root, date_paths)
+            
+            # Extract access key (the signed infNFe Id first, then the authorization protocol)
+            chave = re.sub(r'^NFe', '', inf_nodes[0].get('Id', '')) if inf_nodes else ''
+            if not chave:
+                chave = self._get_element_text(document, ['.//protNFe//chNFe'])
+            data['chave_acesso'] = chave
+            
+            # Extract purchase order reference
+            data['pedido_compra'] = self._get_element_text(root, ['.//compra/xPed'])
                 
             # Extract total value (try multiple paths)
             value_paths = ['.//vNF', './/ICMSTot/vNF', './/infNFe//vNF']
@@ -152,6 +1211,7 @@ class InvoiceAuditTool(BaseTool):
                 data['emitente'] = {
                     'nome': self._get_element_text(emit, ['xNome']),
                     'cnpj': self._get_element_text(emit, ['CNPJ']),
+                    'cpf': self._get_element_text(emit, ['CPF']),
                 }
                 
             # Extract destination (client) info
@@ -166,6 +1226,7 @@ class InvoiceAuditTool(BaseTool):
                 data['destinatario'] = {
                     'nome': self._get_element_text(dest, ['xNome']),
                     'cnpj': self._get_element_text(dest, ['CNPJ']),
+                    'cpf': self._get_element_text(dest, ['CPF']),
                 }
                 
             # Extract products
@@ -195,6 +1256,9 @@ class InvoiceAuditTool(BaseTool):
                             product = {
                                 'codigo': self._get_element_text(prod, ['cProd']),
                                 'descricao': self._get_element_text(prod, ['xProd']),
+                                'ncm': self._get_element_text(prod, ['NCM']),
+                                'cfop': self._get_element_text(prod, ['CFOP']),
+                                'pedido': self._get_element_text(prod, ['xPed']),
                                 'quantidade': quantity,
                                 'valor_unitario': unit_value,
                                 'valor_total': total_value,
@@ -219,9 +1283,35 @@ class InvoiceAuditTool(BaseTool):
         except Exception as e:
             return f"Erro ao processar nota fiscal: {str(e)}"
 
-    def _perform_audit(self, invoice: Dict, validator: InvoiceValidator) -> Dict:
+    async def _arun(self, invoice_data: str) -> str:
+        """Versão assíncrona: o parse e a auditoria rodam em um executor, sem bloquear o event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self._run, invoice_data))
+
+    def _batch_issues(self, invoices: List[Dict]) -> List[Dict[str, List[str]]]:
+        """Roda uma única vez, sobre todas as notas, as validações feitas em lote.
+        
+        Cada item é repassado como argumentos nomeados a _perform_audit da nota
+        correspondente.
+        """
+        fiscal_issues = self.fiscal_code_validator.validate_invoices(invoices)
+        if self.purchase_order_matcher is None:
+            return [{'fiscal_issues': issues} for issues in fiscal_issues]
+        purchase_order_issues = self.purchase_order_matcher.match_invoices(invoices)
+        return [{'fiscal_issues': fiscal, 'purchase_order_issues': purchase}
+                for fiscal, purchase in zip(fiscal_issues, purchase_order_issues)]
+
+    def _perform_audit(self, invoice: Dict, validator: InvoiceValidator,
+                       fiscal_issues: Optional[List[str]] = None,
+                       purchase_order_issues: Optional[List[str]] = None) -> Dict:
         issues = []
         
+        # Structural errors reported by the XSD validation
+        for error in invoice.get('erros_schema', []):
+            issues.append(f"Erro de schema: {error}")
+        for error in invoice.get('erros_assinatura', []):
+            issues.append(f"Assinatura digital inválida: {error}")
+        
         # Check basic required fields
         if not invoice.get('numero_nf'):
             issues.append("Número da NF ausente")
@@ -230,18 +1320,28 @@ class InvoiceAuditTool(BaseTool):
         
         # Check emitente info
         emitente = invoice.get('emitente', {})
-        if not emitente.get('cnpj'):
+        if not emitente.get('cnpj') and not emitente.get('cpf'):
             issues.append("CNPJ do emitente ausente")
         if not emitente.get('nome'):
             issues.append("Nome do emitente ausente")
         
         # Check destinatario info
         destinatario = invoice.get('destinatario', {})
-        if not destinatario.get('cnpj'):
+        if not destinatario.get('cnpj') and not destinatario.get('cpf'):
             issues.append("CNPJ do destinatário ausente")
         if not destinatario.get('nome'):
             issues.append("Nome do destinatário ausente")
         
+        # Check fiscal identifiers (check digits and code tables), unless already done for the whole batch
+        issues.extend(self._validate_fiscal_codes(invoice) if fiscal_issues is None else fiscal_issues)
+        
+        # Check purchase order alignment (cumulative invoiced quantities live in the matcher)
+        issues.extend(self._validate_purchase_order(invoice) if purchase_order_issues is None else purchase_order_issues)
+        
+        # Check unit prices against the supplier's own history
+        if self.price_history is not None:
+            issues.extend(self.price_history.check_invoice(invoice))
+        
         # Check products
         produtos = invoice.get('produtos', [])
         if not produtos:
@@ -268,13 +1368,15 @@ class InvoiceAuditTool(BaseTool):
         # Implement tax calculation validation logic
         return True
 
-    def _validate_fiscal_codes(self, invoice: Dict) -> bool:
-        # Implement fiscal code validation logic
-        return True
+    def _validate_fiscal_codes(self, invoice: Dict) -> List[str]:
+        """Devolve os problemas encontrados nos identificadores fiscais da nota."""
+        return self.fiscal_code_validator.validate_invoices([invoice])[0]
 
-    def _validate_purchase_order(self, invoice: Dict) -> bool:
-        # Implement purchase order validation logic
-        return True
+    def _validate_purchase_order(self, invoice: Dict) -> List[str]:
+        """Devolve as divergências entre a nota e os pedidos de compra (se houver base de pedidos)."""
+        if self.purchase_order_matcher is None:
+            return []
+        return self.purchase_order_matcher.match_invoices([invoice])[0]
 
     def _generate_audit_report(self, audit_results: Dict) -> str:
         report = f"""
@@ -289,6 +1391,315 @@ class InvoiceAuditTool(BaseTool):
         """
         return report
 
+class InvoiceBatchInput(BaseModel):
+    invoices: List[str] = Field(description="Lista de XMLs de NF-e ou de caminhos para arquivos XML")
+
+class InvoiceBatchAuditTool(BaseTool):
+    """Variante em lote do InvoiceAuditTool: audita várias notas em uma única chamada da ferramenta."""
+    name: str = "invoice_batch_auditor"
+    description: str = (
+        "Validates and audits many invoices at once for tax compliance. "
+        "Input is a list of NF-e XML strings or XML file paths; returns one structured result per invoice."
+    )
+    args_schema: Type[BaseModel] = InvoiceBatchInput
+    audit_tool: InvoiceAuditTool = Field(default_factory=InvoiceAuditTool)
+    max_concurrency: int = 8
+
+    def _parse_one(self, index: int, entry: str) -> Tuple[Dict, Optional[Dict]]:
+        """Converte uma entrada (XML ou caminho); devolve o resultado parcial e a nota (None se falhar)."""
+        is_xml = entry.lstrip().startswith('<')
+        result = {"entrada": f"xml[{index}]" if is_xml else entry}
+        try:
+            xml_content = entry if is_xml else read_xml_file(entry)
+            return result, self.audit_tool._xml_to_dict(xml_content)
+        except Exception as e:
+            result["erro"] = str(e)
+            return result, None
+
+    def _audit_parsed(self, parsed: List[Tuple[Dict, Optional[Dict]]]) -> List[Dict]:
+        """Audita as notas convertidas, com as validações em lote rodando uma vez sobre todas."""
+        invoices = [invoice for _, invoice in parsed if invoice is not None]
+        batch_issues = iter(self.audit_tool._batch_issues(invoices))
+        validator = InvoiceValidator()
+        results = []
+        for result, invoice in parsed:
+            if invoice is not None:
+                try:
+                    audit_results = self.audit_tool._perform_audit(invoice, validator, **next(batch_issues))
+                    result.update({
+                        "numero_nf": audit_results['numero_nf'],
+                        "chave_acesso": invoice.get('chave_acesso', ''),
+                        "status": audit_results['status'],
+                        "issues": audit_results['issues'],
+                    })
+                except Exception as e:
+                    result["erro"] = str(e)
+            results.append(result)
+        return results
+
+    def _run(self, invoices: List[str]) -> List[Dict]:
+        return self._audit_parsed([self._parse_one(index, entry) for index, entry in enumerate(invoices)])
+
+    async def _arun(self, invoices: List[str]) -> List[Dict]:
+        """Converte as notas concorrentemente no executor (no máximo `max_concurrency` simultâneas) e audita o lote de uma vez."""
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def parse(index: int, entry: str) -> Tuple[Dict, Optional[Dict]]:
+            async with semaphore:
+                return await loop.run_in_executor(None, self._parse_one, index, entry)
+        
+        parsed = await asyncio.gather(*(parse(index, entry) for index, entry in enumerate(invoices)))
+        return await loop.run_in_executor(None, self._audit_parsed, list(parsed))
+
+class RiskTriage:
+    """Pontuação local de risco que decide quais notas precisam de análise de IA.
+    
+    Notas reprovadas sempre vão ao modelo, então a pontuação só considera
+    sinais que uma nota aprovada pode ter: hoje, o valor total acima de
+    `high_value`. Notas aprovadas com pontuação abaixo de `threshold` recebem
+    um resumo determinístico, sem chamada ao modelo; com os padrões, toda nota
+    de valor alto vai ao modelo.
+    """
+    def __init__(self, threshold: float = 1.0, high_value: float = 50000.0,
+                 high_value_weight: float = 1.0):
+        self.threshold = threshold
+        self.high_value = high_value
+        self.high_value_weight = high_value_weight
+
+    def score(self, invoice: Dict, audit_results: Dict) -> Tuple[float, List[str]]:
+        """Calcula a pontuação de risco e os motivos que a compõem."""
+        score = 0.0
+        reasons = []
+        
+        valor_total = invoice.get('valor_total', 0)
+        if valor_total > self.high_value:
+            score += self.high_value_weight
+            reasons.append(f"valor total acima de {self.high_value:.2f}")
+        
+        return score, reasons
+
+    def is_high_risk(self, score: float, audit_results: Dict) -> bool:
+        return audit_results.get('status') != 'PASSED' or score >= self.threshold
+
+    def canned_analysis(self, audit_results: Dict, score: float, reasons: List[str]) -> Dict:
+        """Monta a análise padrão, no mesmo formato da resposta do modelo, para notas de baixo risco."""
+        if audit_results.get('status') != 'PASSED':
+            raise ValueError("A análise padrão só se aplica a notas aprovadas na auditoria")
+        resumo = "Nota fiscal aprovada na auditoria automática."
+        if reasons:
+            resumo += " Observações: " + "; ".join(reasons) + "."
+        return {
+            "numero_nf": audit_results.get('numero_nf', 'N/A'),
+            "resumo": resumo,
+            "avaliacao_risco": f"Baixo (pontuação {score:.2f}, limite {self.threshold:.2f})",
+            "acoes_recomendadas": ["Nenhuma ação adicional necessária; arquivar a nota fiscal."],
+            "triagem_local": True
+        }
+
+class _RollingPercentile:
+    """Janela deslizante de amostras com cálculo de percentil."""
+    def __init__(self, window: int):
+        self.window = window
+        self._values: deque = deque()
+        self._sorted: List[float] = []
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def add(self, value: float):
+        self._values.append(value)
+        bisect.insort(self._sorted, value)
+        if len(self._values) > self.window:
+            oldest = self._values.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+
+    def percentile(self, p: float) -> float:
+        index = min(len(self._sorted) - 1, int(p / 100.0 * len(self._sorted)))
+        return self._sorted[index]
+
+class _StackSampler:
+    """Amostrador de pilhas em thread própria, no formato "collapsed" usado por flamegraphs.
+    
+    A cada `interval` segundos lê o frame atual de cada thread registrada
+    (sys._current_frames) e conta a pilha abaixo de `root_code`; a primeira
+    amostra é tirada assim que a thread é registrada. A nota medida só paga o
+    registro da thread, então toda chamada pode ser amostrada.
+    """
+    def __init__(self, root_code, interval: float = 0.001):
+        self.root_code = root_code
+        self.interval = interval
+        self._active: Dict[int, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._has_work = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> Dict[str, int]:
+        """Passa a amostrar a thread atual; devolve o dicionário de amostras (pilha -> contagem)."""
+        samples: Dict[str, int] = {}
+        with self._lock:
+            self._active[threading.get_ident()] = samples
+            self._has_work.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="invoice-profiler-sampler", daemon=True)
+                self._thread.start()
+        return samples
+
+    def stop(self):
+        """Para de amostrar a thread atual; depois disso suas amostras não mudam mais."""
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+            if not self._active:
+                self._has_work.clear()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._has_work.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _collapse(self, frame) -> Optional[str]:
+        labels = []
+        while frame is not None and frame.f_code is not self.root_code:
+            code = frame.f_code
+            labels.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':'))
+            frame = frame.f_back
+        return ";".join(reversed(labels)) if frame is not None and labels else None
+
+    def _loop(self):
+        while True:
+            self._has_work.wait()
+            with self._lock:
+                if self._closed:
+                    return
+                frames = sys._current_frames()
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    path = self._collapse(frame) if frame is not None else None
+                    if path:
+                        samples[path] = samples.get(path, 0) + 1
+            time.sleep(self.interval)
+
+    @staticmethod
+    def dump(samples: Dict[str, int], file_path: str):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            for path, count in sorted(samples.items()):
+                f.write(f"{path} {count}\n")
+
+class _Measurement:
+    """Latência, memória e perfis acumulados de uma nota, possivelmente em várias etapas."""
+    def __init__(self, deterministic: bool):
+        self.latency = 0.0
+        self.memory = 0
+        self.samples: Dict[str, int] = {}
+        self.profile = cProfile.Profile() if deterministic else None
+
+class InvoiceProfiler:
+    """Modo de perfil: mede cada nota e guarda perfis apenas das mais lentas.
+    
+    Toda nota roda sob um amostrador de pilhas (e, com `deterministic`, também
+    sob cProfile), com a latência medida por cronômetro e a memória por
+    tracemalloc, se `track_memory`. Quando a nota fica acima do percentil
+    configurado, o perfil daquela mesma execução é gravado: um `.collapsed`
+    (para flamegraph.pl ou speedscope) e, com `deterministic`, um `.pstats`.
+    Uma nota atípica curta demais para receber alguma amostra não gera captura
+    (exceto o `.pstats`, no modo determinístico).
+    Nada é reexecutado, então causas passageiras da lentidão (GC, E/S,
+    disputa de locks) aparecem no perfil e efeitos colaterais da auditoria
+    acontecem uma única vez.
+    
+    Uma nota processada em etapas (como no lote, em que as validações
+    compartilhadas rodam entre o parse e a auditoria) é medida com `measure`
+    em cada etapa e avaliada uma única vez com `record`.
+    """
+    def __init__(self, output_dir: str, percentile: float = 95.0, min_samples: int = 20,
+                 window: int = 1000, track_memory: bool = False, deterministic: bool = False,
+                 sample_interval: float = 0.001):
+        self.output_dir = output_dir
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.track_memory = track_memory
+        self.deterministic = deterministic
+        self.stats: Dict[str, int] = {"medidas": 0, "capturadas": 0}
+        self.captures: List[Dict] = []
+        
+        self._latencies = _RollingPercentile(window)
+        self._memory = _RollingPercentile(window)
+        self._lock = threading.Lock()
+        self._sampler = _StackSampler(InvoiceProfiler.measure.__code__, sample_interval)
+        os.makedirs(output_dir, exist_ok=True)
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def close(self):
+        self._sampler.close()
+        if self.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def run(self, label: str, func):
+        """Executa `func` medindo latência/memória e grava o perfil desta execução se a nota for atípica."""
+        measurement = self.new_measurement()
+        result = self.measure(func, measurement)
+        self.record(label, measurement)
+        return result
+
+    def new_measurement(self) -> _Measurement:
+        return _Measurement(self.deterministic)
+
+    def measure(self, func, measurement: _Measurement):
+        """Executa uma etapa da nota, somando latência e perfis em `measurement`."""
+        # Com várias threads a memória medida é aproximada, pois o tracemalloc é global ao processo
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        profile = measurement.profile
+        samples = self._sampler.start()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(func) if profile is not None else func()
+        finally:
+            measurement.latency += time.perf_counter() - start
+            self._sampler.stop()
+            for path, count in samples.items():
+                measurement.samples[path] = measurement.samples.get(path, 0) + count
+            if self.track_memory:
+                measurement.memory = max(measurement.memory, tracemalloc.get_traced_memory()[1] - baseline)
+
+    def record(self, label: str, measurement: _Measurement):
+        """Avalia a nota já medida e grava seu perfil se ela for atípica."""
+        latency, memory = measurement.latency, measurement.memory
+        with self._lock:
+            self.stats["medidas"] += 1
+            outlier = False
+            if len(self._latencies) >= self.min_samples:
+                outlier = latency > self._latencies.percentile(self.percentile)
+                if self.track_memory:
+                    outlier = outlier or memory > self._memory.percentile(self.percentile)
+            self._latencies.add(latency)
+            self._memory.add(memory)
+        
+        if outlier:
+            self._save(label, measurement.samples, measurement.profile, latency, memory)
+
+    def _save(self, label: str, samples: Dict[str, int], profile, latency: float, memory: int):
+        safe_label = re.sub(r'[^\w.-]', '_', label) or 'nota'
+        base_path = os.path.join(self.output_dir, f"{safe_label}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}")
+        if not samples and profile is None:
+            return
+        capture = {"nota": label, "latencia": latency, "memoria_pico": memory}
+        if samples:
+            capture["collapsed"] = base_path + '.collapsed'
+            _StackSampler.dump(samples, capture["collapsed"])
+        if profile is not None:
+            capture["pstats"] = base_path + '.pstats'
+            pstats.Stats(profile).dump_stats(capture["pstats"])
+        
+        with self._lock:
+            self.stats["capturadas"] += 1
+            self.captures.append(capture)
+
 class NFSystemGUI:
     def __init__(self):
         self.root = tk.Tk()
@@ -330,7 +1741,12 @@ class NFSystemGUI:
         status_label.pack(fill=tk.X, side=tk.BOTTOM, pady=(5, 0))
     
     def select_file(self):
-        success, message = self.nf_system.select_file()
+        self._show_loaded(*self.nf_system.select_file())
+    
+    def open_file(self, file_path: str):
+        self._show_loaded(*self.nf_system.load_file(file_path))
+    
+    def _show_loaded(self, success: bool, message: str):
         if success:
             self.status_var.set("Arquivo carregado com sucesso")
             self.text_display.delete(1.0, tk.END)
@@ -381,6 +1797,36 @@ class NFSystem:
         self.current_file: Optional[str] = None
         self.current_result: Optional[str] = None
         self.analysis_result: Optional[str] = None
+        self.batch_size: int = 10
+        self.batch_results: Dict[str, Dict] = {}
+        # Triagem de risco; defina como None para enviar todas as notas ao modelo
+        self.triage: Optional[RiskTriage] = RiskTriage()
+        self.triage_stats: Dict[str, int] = {"enviadas_ia": 0, "evitadas_ia": 0, "requisicoes_ia": 0}
+        # Perfil opcional de cada processamento (veja InvoiceProfiler)
+        self.profiler: Optional[InvoiceProfiler] = None
+
+    def configure(self, schema_dir: Optional[str] = None, verify_signatures: bool = False,
+                  trusted_certs: Optional[List[str]] = None, purchase_orders: Optional[str] = None,
+                  price_history: Optional[str] = None, shared_price_history: bool = False,
+                  purchase_order_state: Optional[str] = None):
+        """Ativa as validações opcionais da auditoria (schema, assinatura, pedidos de compra e histórico de preços)."""
+        if schema_dir:
+            self.audit_tool.schema_validator = NFeSchemaValidator(schema_dir)
+        if verify_signatures or trusted_certs:
+            self.audit_tool.signature_verifier = NFeSignatureVerifier(trusted_certs)
+        if purchase_orders:
+            self.audit_tool.purchase_order_matcher = PurchaseOrderMatcher.from_file(purchase_orders,
+                                                                                    state_path=purchase_order_state)
+        if price_history:
+            self.audit_tool.price_history = PriceHistory(price_history, shared=shared_price_history)
+
+    def close(self):
+        """Grava o estado pendente das validações opcionais e fecha seus bancos."""
+        if self.audit_tool.purchase_order_matcher is not None:
+            self.audit_tool.purchase_order_matcher.close()
+        if self.audit_tool.price_history is not None:
+            self.audit_tool.price_history.close()
+            self.audit_tool.price_history = None
 
     def _format_currency(self, value: float) -> str:
         """Formata valores monetários no padrão brasileiro."""
@@ -432,6 +1878,67 @@ class NFSystem:
         
         return "\n".join(output)
 
+    def _read_xml_file(self, file_path: str) -> str:
+        """Lê o arquivo XML tentando diferentes codificações."""
+        return read_xml_file(file_path)
+
+    def _process_xml(self, xml_content: str, label: str,
+                     signature_errors: Optional[List[str]] = None) -> Tuple[Dict, Dict, str]:
+        """Faz o parse, a auditoria e a formatação de uma nota, sob o profiler quando ativado."""
+        def process():
+            invoice_data = self.audit_tool._xml_to_dict(xml_content, signature_errors)
+            audit_results = self.audit_tool._perform_audit(invoice_data, InvoiceValidator())
+            return invoice_data, audit_results, self._format_invoice_data(invoice_data)
+        
+        if self.profiler is not None:
+            return self.profiler.run(label, process)
+        return process()
+
+    def _process_xmls(self, entries: List[Tuple[str, str, Optional[List[str]]]]) -> List[Union[Tuple[Dict, Dict, str], Exception]]:
+        """Versão em lote de _process_xml para entradas (xml, rótulo, erros de assinatura).
+        
+        As validações em lote rodam uma única vez sobre todas as notas. O profiler
+        mede parse, auditoria e formatação de cada nota como uma única captura
+        (as validações compartilhadas do lote ficam de fora). Cada posição do
+        resultado traz a tupla de _process_xml ou a exceção daquela nota.
+        """
+        def measured(func, measurement):
+            return self.profiler.measure(func, measurement) if measurement is not None else func()
+        
+        parsed: List[Union[Dict, Exception]] = []
+        measurements = []
+        for xml_content, label, signature_errors in entries:
+            measurement = self.profiler.new_measurement() if self.profiler is not None else None
+            measurements.append(measurement)
+            try:
+                parsed.append(measured(functools.partial(self.audit_tool._xml_to_dict, xml_content, signature_errors),
+                                       measurement))
+            except Exception as e:
+                parsed.append(e)
+        
+        invoices = [item for item in parsed if not isinstance(item, Exception)]
+        batch_issues = iter(self.audit_tool._batch_issues(invoices))
+        validator = InvoiceValidator()
+        results: List[Union[Tuple[Dict, Dict, str], Exception]] = []
+        for (_, label, _), item, measurement in zip(entries, parsed, measurements):
+            if isinstance(item, Exception):
+                results.append(item)
+                continue
+            issues = next(batch_issues)
+            
+            def audit_and_format(item=item, issues=issues):
+                audit_results = self.audit_tool._perform_audit(item, validator, **issues)
+                return item, audit_results, self._format_invoice_data(item)
+            
+            try:
+                results.append(measured(audit_and_format, measurement))
+            except Exception as e:
+                results.append(e)
+                continue
+            if measurement is not None:
+                self.profiler.record(label, measurement)
+        return results
+
     def select_file(self) -> Tuple[bool, str]:
         root = tk.Tk()
         root.withdraw()  # Hide the main window
@@ -440,32 +1947,20 @@ class NFSystem:
             filetypes=[("XML files", "*.xml"), ("All files", "*.*")]
         )
         if file_path:
-            try:
-                # Tenta diferentes codificações
-                encodings = ['utf-8', 'iso-8859-1', 'latin1', 'cp1252']
-                xml_content = None
-                
-                for encoding in encodings:
-                    try:
-                        with open(file_path, 'r', encoding=encoding) as f:
-                            xml_content = f.read()
-                        break
-                    except UnicodeDecodeError:
-                        continue
-                
-                if xml_content is None:
-                    # Se nenhuma codificação funcionou, tenta leitura binária
-                    with open(file_path, 'rb') as f:
-                        xml_content = f.read().decode('utf-8', errors='ignore')
-                
-                invoice_data = self.audit_tool._xml_to_dict(xml_content)
-                self.current_file = file_path
-                formatted_data = self._format_invoice_data(invoice_data)
-                return True, f"Arquivo selecionado: {file_path}\n\n{formatted_data}"
-            except Exception as e:
-                return False, f"Erro ao ler o arquivo: {str(e)}\nTente verificar se o arquivo está em um formato XML válido e se não está corrompido."
+            return self.load_file(file_path)
         return False, "Nenhum arquivo selecionado"
 
+    def load_file(self, file_path: str) -> Tuple[bool, str]:
+        """Carrega o XML como arquivo atual, sem abrir o diálogo de seleção."""
+        try:
+            xml_content = self._read_xml_file(file_path)
+            invoice_data = self.audit_tool._xml_to_dict(xml_content)
+            self.current_file = file_path
+            formatted_data = self._format_invoice_data(invoice_data)
+            return True, f"Arquivo selecionado: {file_path}\n\n{formatted_data}"
+        except Exception as e:
+            return False, f"Erro ao ler o arquivo: {str(e)}\nTente verificar se o arquivo está em um formato XML válido e se não está corrompido."
+
     def analyze_invoice(self) -> Tuple[bool, str]:
         if not self.current_file:
             return False, "Nenhum arquivo selecionado. Por favor, selecione um arquivo primeiro."
@@ -474,28 +1969,202 @@ class NFSystem:
             with open(self.current_file, 'r', encoding='utf-8') as f:
                 xml_content = f.read()
             
-            invoice_data = self.audit_tool._xml_to_dict(xml_content)
-            formatted_data = self._format_invoice_data(invoice_data)
-            self.current_result = self.audit_tool._run(xml_content)
+            invoice_data, audit_results, formatted_data = self._process_xml(
+                xml_content, os.path.basename(self.current_file))
+            self.current_result = self.audit_tool._generate_audit_report(audit_results)
             
-            # Generate AI analysis
-            prompt = f"""
+            canned = self._triage_invoice(invoice_data, audit_results)
+            if canned is not None:
+                self.analysis_result = self._format_analysis(canned)
+            else:
+                # Generate AI analysis
+                prompt = self._build_analysis_prompt(self.current_result)
+                self.triage_stats["requisicoes_ia"] += 1
+                response = model.generate_content(prompt)
+                self.analysis_result = response.text
+            
+            return True, f"{formatted_data}\n\nAnálise concluída com sucesso!"
+        except Exception as e:
+            return False, f"Erro durante a análise: {str(e)}"
+
+    def _triage_invoice(self, invoice_data: Dict, audit_results: Dict) -> Optional[Dict]:
+        """Devolve a análise padrão se a nota for de baixo risco, ou None se ela deve ir ao modelo."""
+        if self.triage is None:
+            self.triage_stats["enviadas_ia"] += 1
+            return None
+        
+        score, reasons = self.triage.score(invoice_data, audit_results)
+        if self.triage.is_high_risk(score, audit_results):
+            self.triage_stats["enviadas_ia"] += 1
+            return None
+        self.triage_stats["evitadas_ia"] += 1
+        return self.triage.canned_analysis(audit_results, score, reasons)
+
+    def _format_analysis(self, analysis: Dict) -> str:
+        """Formata uma análise estruturada como texto."""
+        acoes = "\n".join(f"- {acao}" for acao in analysis.get('acoes_recomendadas', []))
+        return (
+            f"1. Resumo das descobertas\n{analysis.get('resumo', '')}\n\n"
+            f"2. Avaliação de risco\n{analysis.get('avaliacao_risco', '')}\n\n"
+            f"3. Ações recomendadas\n{acoes}"
+        )
+
+    def _build_analysis_prompt(self, audit_report: str) -> str:
+        """Monta o prompt de análise de IA para um único relatório de auditoria."""
+        return f"""
             Você é um assistente de auditoria fiscal. Analise este relatório de auditoria e forneça insights:
             
-            {self.current_result}
+            {audit_report}
             
             Por favor, forneça:
             1. Resumo das descobertas
             2. Avaliação de risco
             3. Ações recomendadas
             """
+
+    def _build_batch_prompt(self, reports: Dict[str, str]) -> str:
+        """Monta um único prompt com vários relatórios, identificados por um apelido do lote."""
+        sections = []
+        for alias, report in reports.items():
+            sections.append(f"### Relatório {alias}\n{report.strip()}")
+        joined_reports = "\n\n".join(sections)
+        return f"""
+            Você é um assistente de auditoria fiscal. Analise cada um dos relatórios de auditoria abaixo
+            e forneça insights individuais para cada nota fiscal.
             
-            response = model.generate_content(prompt)
-            self.analysis_result = response.text
+            {joined_reports}
             
-            return True, f"{formatted_data}\n\nAnálise concluída com sucesso!"
-        except Exception as e:
-            return False, f"Erro durante a análise: {str(e)}"
+            Responda somente com um array JSON contendo exatamente um objeto por nota fiscal, com os campos:
+            id (exatamente como informado no título do relatório), resumo, avaliacao_risco
+            e acoes_recomendadas (lista de ações).
+            """
+
+    def _parse_batch_response(self, response_text: str, expected_ids: List[str]) -> Dict[str, Dict]:
+        """Converte a resposta JSON do lote em um dicionário indexado pelo apelido de cada relatório."""
+        text = response_text.strip()
+        # Remove cercas de código markdown, caso o modelo as inclua
+        if text.startswith("```"):
+            text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text)
+        
+        try:
+            entries = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Resposta do lote não é um JSON válido: {str(e)}")
+        if not isinstance(entries, list):
+            raise ValueError("Resposta do lote não é uma lista de análises")
+        
+        results = {}
+        for entry in entries:
+            if isinstance(entry, dict) and str(entry.get("id")) in expected_ids:
+                results[str(entry.pop("id"))] = entry
+        
+        missing = [alias for alias in expected_ids if alias not in results]
+        if missing:
+            raise ValueError(f"Resposta do lote sem análise para: {', '.join(missing)}")
+        return results
+
+    def _request_analysis(self, reports: Dict[str, str]) -> Dict[str, Dict]:
+        """Envia um lote de relatórios ao modelo e devolve as análises estruturadas.
+        
+        Os relatórios são indexados por arquivo; no prompt e na resposta cada um
+        aparece só com um apelido curto do lote ("1", "2", ...).
+        """
+        self.triage_stats["requisicoes_ia"] += 1
+        aliases = {str(n): key for n, key in enumerate(reports, start=1)}
+        response = model.generate_content(
+            self._build_batch_prompt({alias: reports[key] for alias, key in aliases.items()}),
+            generation_config=genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=BATCH_RESPONSE_SCHEMA
+            )
+        )
+        parsed = self._parse_batch_response(response.text, list(aliases))
+        return {aliases[alias]: entry for alias, entry in parsed.items()}
+
+    def _analyze_batch(self, reports: Dict[str, str]) -> Dict[str, Dict]:
+        """Analisa um lote e, se a resposta não puder ser interpretada, refaz as análises individualmente.
+        
+        Só a resposta ilegível (ValueError de _parse_batch_response) leva às
+        requisições individuais; erros da API (cota, rede) são propagados e o
+        lote é marcado com erro, sem multiplicar as requisições.
+        """
+        try:
+            return self._request_analysis(reports)
+        except ValueError:
+            if len(reports) == 1:
+                raise
+        
+        results = {}
+        for key, report in reports.items():
+            try:
+                results.update(self._request_analysis({key: report}))
+            except ValueError as e:
+                results[key] = {"erro": str(e)}
+        return results
+
+    def analyze_invoices(self, file_paths: List[str]) -> Tuple[bool, str]:
+        """Audita várias notas fiscais e agrupa as análises de IA em lotes de `batch_size`.
+        
+        `batch_results` fica indexado pelo caminho do arquivo, já que o número
+        da NF se repete entre fornecedores e séries.
+        """
+        if not file_paths:
+            return False, "Nenhum arquivo informado para análise em lote."
+        
+        self.batch_results = {}
+        errors = []
+        batches: List[Dict[str, str]] = [{}]
+        numeros_nf: Dict[str, str] = {}
+        
+        # As assinaturas são verificadas antes, em paralelo, sobre os bytes originais
+        signature_results: Dict[str, List[str]] = {}
+        if self.audit_tool.signature_verifier is not None:
+            signature_results = self.audit_tool.signature_verifier.verify_files(file_paths)
+        
+        entries, read_paths = [], []
+        for file_path in file_paths:
+            try:
+                entries.append((self._read_xml_file(file_path), os.path.basename(file_path),
+                                signature_results.get(file_path)))
+                read_paths.append(file_path)
+            except Exception as e:
+                errors.append(f"{file_path}: {str(e)}")
+        
+        for file_path, outcome in zip(read_paths, self._process_xmls(entries)):
+            if isinstance(outcome, Exception):
+                errors.append(f"{file_path}: {str(outcome)}")
+                continue
+            invoice_data, audit_results, _ = outcome
+            
+            numeros_nf[file_path] = invoice_data.get('numero_nf') or os.path.basename(file_path)
+            canned = self._triage_invoice(invoice_data, audit_results)
+            if canned is not None:
+                canned["numero_nf"] = numeros_nf[file_path]
+                self.batch_results[file_path] = canned
+                continue
+            
+            if len(batches[-1]) >= self.batch_size:
+                batches.append({})
+            batches[-1][file_path] = self.audit_tool._generate_audit_report(audit_results)
+        
+        batches = [batch for batch in batches if batch]
+        for batch in batches:
+            try:
+                analyses = self._analyze_batch(batch)
+            except Exception as e:
+                analyses = {file_path: {"erro": str(e)} for file_path in batch}
+            for file_path, analysis in analyses.items():
+                analysis["numero_nf"] = numeros_nf[file_path]
+                self.batch_results[file_path] = analysis
+        
+        message = (
+            f"{len(self.batch_results)} nota(s) analisada(s) em {len(batches)} lote(s). "
+            f"Triagem: {self.triage_stats['enviadas_ia']} enviada(s) à IA, "
+            f"{self.triage_stats['evitadas_ia']} resolvida(s) localmente."
+        )
+        if errors:
+            message += "\n\nArquivos com erro:\n" + "\n".join(errors)
+        return bool(self.batch_results), message
 
     def save_results(self) -> Tuple[bool, str]:
         if not self.current_result:
@@ -575,105 +2244,930 @@ class NFSystem:
         except Exception as e:
             return False, f"Erro ao enviar email: {str(e)}"
 
-def show_menu():
-    menu = """
-    === SISTEMA DE ANÁLISE DE NOTAS FISCAIS ===
+class _Inotify:
+    """Interface mínima para o inotify do Linux via ctypes."""
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or not libc_name:
+            raise OSError("inotify não disponível nesta plataforma")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Falha ao inicializar o inotify")
+        self.watches: Dict[int, str] = {}
+        # Fila de eventos do kernel estourou: eventos foram perdidos e os diretórios precisam ser varridos
+        self.overflowed = False
+
+    def add_watch(self, directory: str):
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Falha ao monitorar {directory}")
+        self.watches[wd] = directory
+
+    def read_paths(self, timeout: float) -> List[str]:
+        """Aguarda eventos por até `timeout` segundos e devolve os caminhos afetados.
+        
+        Se o kernel descartou eventos (IN_Q_OVERFLOW), marca `overflowed`; se um
+        diretório deixou de ser monitorado (removido ou desmontado), sai de `watches`.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        
+        paths = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _cookie, length = self._EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self._EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif name and wd in self.watches:
+                paths.append(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+class InvoiceWatcher:
+    """Monitora diretórios e audita continuamente os novos XMLs de NF-e (modo headless).
+    
+    Usa inotify quando disponível e, caso contrário, consulta os diretórios
+    periodicamente; se a fila do inotify estourar, os diretórios são varridos
+    de novo para não perder arquivos. Um arquivo só é auditado depois de ficar `settle_time`
+    segundos sem mudar de tamanho ou data de modificação, para não ler
+    arquivos ainda em gravação.
+    """
+    def __init__(self, directories: List[str], output_dir: str, workers: int = 4,
+                 settle_time: float = 0.5, poll_interval: float = 0.5,
+                 use_inotify: bool = True, process_existing: bool = False,
+                 nf_system: Optional['NFSystem'] = None, archive: Optional['InvoiceArchive'] = None):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.output_dir = output_dir
+        self.workers = workers
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.process_existing = process_existing
+        self.nf_system = nf_system or NFSystem()
+        # Com um arquivo compacto, XML e relatório vão para ele em vez de um .txt por nota
+        self.archive = archive
+        # Com mais de um diretório, os relatórios de cada um ficam em uma subpasta
+        # própria, para que arquivos de mesmo nome não sobrescrevam os relatórios
+        self._report_dirs: Dict[str, str] = {}
+        if len(self.directories) > 1:
+            for directory in self.directories:
+                digest = hashlib.sha1(os.fsencode(directory)).hexdigest()[:8]
+                self._report_dirs[directory] = os.path.join(output_dir, f"{os.path.basename(directory)}-{digest}")
+        self.stats: Dict[str, int] = {"auditadas": 0, "erros": 0}
+        
+        self._inotify: Optional[_Inotify] = None
+        self._known: Dict[str, Tuple[int, int]] = {}
+        self._pending: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        self._stop_event = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if self._inotify is not None else "polling"
+
+    def start(self):
+        """Inicia o monitoramento em uma thread de fundo."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._stop_event.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        
+        if self.use_inotify:
+            try:
+                self._inotify = _Inotify()
+                for directory in self.directories:
+                    self._inotify.add_watch(directory)
+            except OSError:
+                if self._inotify is not None:
+                    self._inotify.close()
+                self._inotify = None
+        
+        # Varredura inicial: registra o que já existe (ou agenda, se process_existing)
+        for path, signature in self._scan():
+            if self.process_existing:
+                self._pending[path] = (signature, time.monotonic())
+            else:
+                self._known[path] = signature
+        
+        self._thread = threading.Thread(target=self._loop, name="invoice-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Interrompe o monitoramento e aguarda as auditorias em andamento."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def run_forever(self):
+        """Executa até receber Ctrl+C (ou até a thread de monitoramento falhar)."""
+        self.start()
+        try:
+            while not self._stop_event.wait(1.0):
+                if not self._thread.is_alive():
+                    raise RuntimeError("A thread de monitoramento foi interrompida inesperadamente")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _scan(self) -> List[Tuple[str, Tuple[int, int]]]:
+        entries = []
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        # O ERP grava em um temporário e renomeia: o arquivo pode sumir entre a listagem e o stat
+                        try:
+                            if entry.is_file() and entry.name.lower().endswith('.xml'):
+                                st = entry.stat()
+                                entries.append((entry.path, (st.st_size, st.st_mtime_ns)))
+                        except OSError:
+                            continue
+            except OSError:
+                continue  # Compartilhamento indisponível no momento; tenta de novo na próxima varredura
+        return entries
+
+    def _reconcile(self):
+        """Agenda os arquivos novos ou alterados desde a última auditoria."""
+        for path, signature in self._scan():
+            if self._known.get(path) != signature:
+                self._touch(path, signature)
+
+    def _rewatch(self):
+        """Volta a monitorar diretórios que foram removidos e recriados."""
+        watched = set(self._inotify.watches.values())
+        for directory in self.directories:
+            if directory not in watched:
+                try:
+                    self._inotify.add_watch(directory)
+                except OSError:
+                    continue
+                self._inotify.overflowed = True  # Eventos do intervalo sem monitoramento se perderam
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            # Falhas transitórias de E/S (compartilhamento fora do ar, arquivo renomeado)
+            # não podem encerrar a thread: a próxima volta tenta de novo
+            try:
+                if self._inotify is not None:
+                    for path in self._inotify.read_paths(timeout=min(self.poll_interval, self.settle_time / 2)):
+                        if path.lower().endswith('.xml'):
+                            self._touch(path)
+                    if len(self._inotify.watches) < len(self.directories):
+                        self._rewatch()
+                    if self._inotify.overflowed:
+                        self._inotify.overflowed = False
+                        self._reconcile()
+                else:
+                    self._reconcile()
+                    self._stop_event.wait(self.poll_interval)
+                self._dispatch_settled()
+            except OSError:
+                self._stop_event.wait(self.poll_interval)
+
+    def _touch(self, path: str, signature: Optional[Tuple[int, int]] = None):
+        """Registra uma mudança no arquivo, reiniciando o tempo de estabilização."""
+        if signature is None:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self._pending.pop(path, None)
+                return
+            signature = (st.st_size, st.st_mtime_ns)
+        previous = self._pending.get(path)
+        if previous is None or previous[0] != signature:
+            self._pending[path] = (signature, time.monotonic())
+
+    def _dispatch_settled(self):
+        now = time.monotonic()
+        for path, (signature, changed_at) in list(self._pending.items()):
+            if now - changed_at < self.settle_time:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != signature:
+                self._pending[path] = (current, now)
+                continue
+            del self._pending[path]
+            if self._known.get(path) != current:
+                self._known[path] = current
+                self._executor.submit(self._process_file, path)
+
+    def _process_file(self, file_path: str):
+        record = {"arquivo": file_path, "auditado_em": datetime.now().isoformat()}
+        try:
+            xml_content = self.nf_system._read_xml_file(file_path)
+            invoice_data, audit_results, formatted_data = self.nf_system._process_xml(
+                xml_content, os.path.basename(file_path))
+            report = self.nf_system.audit_tool._generate_audit_report(audit_results)
+            record.update({
+                "numero_nf": audit_results['numero_nf'],
+                "chave_acesso": invoice_data.get('chave_acesso', ''),
+                "status": audit_results['status'],
+                "issues": audit_results['issues'],
+            })
+            
+            if self.archive is not None:
+                with open(file_path, 'rb') as f:
+                    record["arquivado"] = self.archive.append(f.read(), dict(record, relatorio=report))
+            else:
+                report_dir = self._report_dirs.get(os.path.dirname(file_path), self.output_dir)
+                os.makedirs(report_dir, exist_ok=True)
+                report_path = os.path.join(report_dir, os.path.splitext(os.path.basename(file_path))[0] + '.txt')
+                with open(report_path, 'w', encoding='utf-8') as f:
+                    f.write(formatted_data)
+                    f.write("\n\n")
+                    f.write("=== RELATÓRIO DE AUDITORIA ===\n\n")
+                    f.write(report)
+                record["relatorio"] = report_path
+        except Exception as e:
+            record["erro"] = str(e)
+        
+        with self._write_lock:
+            self.stats["erros" if "erro" in record else "auditadas"] += 1
+            with open(os.path.join(self.output_dir, 'resultados.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+class JobQueueBackend(ABC):
+    """Interface da fila de auditorias usada pelo AuditWorker.
     
-    1. Selecionar arquivo XML
-    2. Analisar nota fiscal
-    3. Salvar resultados
-    4. Enviar resultados por email
-    5. Sair
+    Semântica de lease: um job reservado por `claim` pertence ao worker por
+    `lease_seconds`; o worker o renova com `renew` enquanto trabalha, e se não
+    concluir nem renovar a tempo o job volta à fila. A única implementação é
+    SQLiteJobQueue, para processos de uma mesma máquina.
+    """
+    lease_seconds: float
+
+    @abstractmethod
+    def enqueue(self, file_paths: List[str]) -> int: ...
+
+    @abstractmethod
+    def claim(self, worker_id: str, limit: int = 1) -> List[Dict]: ...
+
+    @abstractmethod
+    def renew(self, job_ids: List[int], worker_id: str) -> int: ...
+
+    @abstractmethod
+    def complete(self, job_id: int, worker_id: str, result: Dict) -> bool: ...
+
+    @abstractmethod
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool: ...
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]: ...
+
+class SQLiteJobQueue(JobQueueBackend):
+    """Fila durável de auditorias em SQLite, com lease, novas tentativas e fila de mortos.
+    
+    Estados: pending -> running -> done; em caso de erro o job volta a pending
+    após `retry_delay` segundos, até `max_attempts` tentativas, e depois vai
+    para dead. Jobs running cujo lease expirou (worker interrompido) são
+    reservados novamente, o que torna a execução retomável.
     
-    Escolha uma opção: """
-    return input(menu)
+    Pode ser usada por vários processos da mesma máquina e por várias threads
+    do mesmo processo. Não use o banco em sistema de arquivos de rede: o modo
+    WAL do SQLite exige memória compartilhada local.
+    """
+    def __init__(self, db_path: str, lease_seconds: float = 300.0, max_attempts: int = 3,
+                 retry_delay: float = 5.0, clock=time.time):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._clock = clock
+        # A renovação de leases do AuditWorker roda em outra thread
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                result TEXT,
+                error TEXT,
+                updated_at REAL
+            )
+        """)
+        # Índices que atendem as buscas do claim sem ordenar todos os pendentes
+        self._conn.execute("DROP INDEX IF EXISTS jobs_claim")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, available_at, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (status, lease_expires)")
 
-if __name__ == "__main__":
-    app = NFSystemGUI()
-    app.run()
-    args = parser.parse_args()
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def enqueue(self, file_paths: List[str]) -> int:
+        """Adiciona arquivos à fila; arquivos já presentes são ignorados. Devolve quantos foram inseridos."""
+        now = self._clock()
+        with self._lock:
+            # Sem isolation_level o sqlite3 não abre transação: cada INSERT seria um commit
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO jobs (path, updated_at) VALUES (?, ?)",
+                    [(os.path.abspath(path), now) for path in file_paths]
+                )
+                inserted = self._conn.total_changes - before
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return inserted
+
+    def claim(self, worker_id: str, limit: int = 1) -> List[Dict]:
+        now = self._clock()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Leases expirados que já esgotaram as tentativas vão direto para a fila de mortos
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'dead', error = COALESCE(error, 'Lease expirado'), lease_owner = NULL, updated_at = ? "
+                    "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                    (now, now, self.max_attempts)
+                )
+                # Leases expirados primeiro (são poucos), depois os pendentes pela ordem do índice
+                rows = self._conn.execute(
+                    "SELECT id, path, attempts FROM jobs WHERE status = 'running' AND lease_expires < ? ORDER BY id LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                if len(rows) < limit:
+                    rows += self._conn.execute(
+                        "SELECT id, path, attempts FROM jobs WHERE status = 'pending' AND available_at <= ? "
+                        "ORDER BY available_at, id LIMIT ?",
+                        (now, limit - len(rows))
+                    ).fetchall()
+                self._conn.executemany(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, "
+                    "lease_expires = ?, updated_at = ? WHERE id = ?",
+                    [(worker_id, now + self.lease_seconds, now, row['id']) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [{"id": row['id'], "path": row['path'], "attempts": row['attempts'] + 1} for row in rows]
+
+    def renew(self, job_ids: List[int], worker_id: str) -> int:
+        """Estende o lease dos jobs ainda reservados por `worker_id`; devolve quantos foram renovados."""
+        now = self._clock()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                    [(now + self.lease_seconds, now, job_id, worker_id) for job_id in job_ids]
+                )
+                renewed = self._conn.total_changes - before
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return renewed
+
+    def complete(self, job_id: int, worker_id: str, result: Dict) -> bool:
+        """Grava o resultado; devolve False se o lease já pertence a outro worker."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_owner = NULL, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                (json.dumps(result, ensure_ascii=False), self._clock(), job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool:
+        now = self._clock()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END, "
+                "available_at = ?, error = ?, lease_owner = NULL, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                (self.max_attempts, now + self.retry_delay, error, now, job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def counts(self) -> Dict[str, int]:
+        counts = {"pending": 0, "running": 0, "done": 0, "dead": 0}
+        with self._lock:
+            for row in self._conn.execute("SELECT status, COUNT(*) AS total FROM jobs GROUP BY status"):
+                counts[row['status']] = row['total']
+        return counts
+
+    def results(self) -> List[Dict]:
+        """Resultados das auditorias concluídas."""
+        with self._lock:
+            return [
+                dict(json.loads(row['result']), arquivo=row['path'])
+                for row in self._conn.execute("SELECT path, result FROM jobs WHERE status = 'done' ORDER BY id")
+            ]
+
+    def dead_letters(self) -> List[Dict]:
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(
+                "SELECT id, path, attempts, error FROM jobs WHERE status = 'dead' ORDER BY id")]
+
+class AuditWorker:
+    """Consome a fila de auditorias, processando cada lote de arquivos com o InvoiceAuditTool.
     
-    # Check if --test parameter is provided
-    if args.test:
-        # Run tests
-        import test_nf
-        unittest.main(module=test_nf, argv=[sys.argv[0]])
-        sys.exit(0)
+    Enquanto um lote é auditado, uma thread renova os leases dos seus jobs a
+    cada `renew_interval` segundos (padrão: um terço do lease da fila), então
+    lotes lentos não são reservados de novo por outro worker.
+    """
+    def __init__(self, queue: JobQueueBackend, worker_id: Optional[str] = None,
+                 batch_size: int = 10, idle_sleep: float = 1.0, nf_system: Optional['NFSystem'] = None,
+                 renew_interval: Optional[float] = None):
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.idle_sleep = idle_sleep
+        self.renew_interval = renew_interval if renew_interval is not None else queue.lease_seconds / 3
+        self.nf_system = nf_system or NFSystem()
+        # Resultados de jobs cujo lease já passou para outro worker não contam
+        self.stats: Dict[str, int] = {"concluidos": 0, "falhas": 0, "leases_perdidos": 0}
+
+    def _audit_batch(self, file_paths: List[str]) -> List[Union[Dict, Exception]]:
+        """Audita os arquivos de um lote de jobs juntos; devolve o resultado ou a exceção de cada um."""
+        outcomes: List[Union[Dict, Exception, None]] = [None] * len(file_paths)
+        entries, positions = [], []
+        for position, file_path in enumerate(file_paths):
+            try:
+                entries.append((self.nf_system._read_xml_file(file_path), os.path.basename(file_path), None))
+                positions.append(position)
+            except Exception as e:
+                outcomes[position] = e
         
-    # Configure Gemini
-    genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-    model = genai.GenerativeModel('gemini-2.5-pro')
+        for position, processed in zip(positions, self.nf_system._process_xmls(entries)):
+            if isinstance(processed, Exception):
+                outcomes[position] = processed
+                continue
+            _, audit_results, _ = processed
+            outcomes[position] = {
+                "numero_nf": audit_results['numero_nf'],
+                "status": audit_results['status'],
+                "issues": audit_results['issues'],
+                "relatorio": self.nf_system.audit_tool._generate_audit_report(audit_results)
+            }
+        return outcomes
+
+    def _renew_leases(self, job_ids: List[int], done: threading.Event):
+        while not done.wait(self.renew_interval):
+            self.queue.renew(job_ids, self.worker_id)
+
+    def run(self, until_empty: bool = True, stop_event: Optional[threading.Event] = None):
+        """Processa jobs até a fila esvaziar (ou até `stop_event`, no modo contínuo)."""
+        while stop_event is None or not stop_event.is_set():
+            jobs = self.queue.claim(self.worker_id, self.batch_size)
+            if not jobs:
+                if until_empty:
+                    return
+                time.sleep(self.idle_sleep)
+                continue
+            done = threading.Event()
+            heartbeat = threading.Thread(target=self._renew_leases, args=([job['id'] for job in jobs], done), daemon=True)
+            heartbeat.start()
+            try:
+                outcomes = self._audit_batch([job['path'] for job in jobs])
+            finally:
+                done.set()
+                heartbeat.join()
+            for job, outcome in zip(jobs, outcomes):
+                if isinstance(outcome, Exception):
+                    recorded = self.queue.fail(job['id'], self.worker_id, str(outcome))
+                    key = "falhas"
+                else:
+                    recorded = self.queue.complete(job['id'], self.worker_id, outcome)
+                    key = "concluidos"
+                self.stats[key if recorded else "leases_perdidos"] += 1
+
+def _run_queue_worker(db_path: str, worker_id: str, queue_options: Dict, audit_options: Dict, until_empty: bool):
+    queue = SQLiteJobQueue(db_path, **queue_options)
+    try:
+        nf_system = NFSystem()
+        nf_system.configure(shared_price_history=True, **audit_options)
+        AuditWorker(queue, worker_id, nf_system=nf_system).run(until_empty=until_empty)
+        nf_system.close()
+    finally:
+        queue.close()
+
+def run_queue_workers(db_path: str, processes: int = 4, until_empty: bool = True,
+                      audit_options: Optional[Dict] = None, **queue_options):
+    """Inicia `processes` workers em processos separados, todos consumindo a mesma fila.
     
-    def generate_sample_xml():
-        root = ET.Element("invoice")
-        ET.SubElement(root, "invoice_id").text = "INV-2025-001"
-        ET.SubElement(root, "supplier_id").text = "789"
-        ET.SubElement(root, "customer_id").text = "123"
+    `audit_options` são repassadas a NFSystem.configure em cada processo.
+    """
+    workers = []
+    for n in range(processes):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{n}"
+        process = multiprocessing.Process(target=_run_queue_worker,
+                                          args=(db_path, worker_id, queue_options, audit_options or {}, until_empty))
+        process.start()
+        workers.append(process)
+    for process in workers:
+        process.join()
+
+class InvoiceArchive:
+    """Arquivo compacto, somente de acréscimo, de XMLs originais e resultados de auditoria.
+    
+    Os registros são gravados comprimidos em arquivos de segmento
+    (`segment-NNNNNN.dat`), com um índice SQLite por chave de acesso e número da
+    NF para leitura aleatória. Como as NF-e são muito repetitivas, depois de
+    `train_after` registros um dicionário de compressão é treinado com eles e
+    usado nos registros seguintes. Usa zstandard quando instalado; caso
+    contrário, zlib com dicionário predefinido.
+    """
+    _RECORD_HEADER = struct.Struct('<4sBHII')
+    _MAGIC = b'NFA1'
+    CODEC_ZSTD = 1
+    CODEC_ZLIB = 2
+
+    def __init__(self, directory: str, segment_size: int = 256 * 1024 * 1024,
+                 compression_level: int = 9, train_after: int = 1000, dict_size: int = 64 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        self.train_after = train_after
+        self.dict_size = dict_size
+        os.makedirs(directory, exist_ok=True)
         
-        items = ET.SubElement(root, "items")
-        item1 = ET.SubElement(items, "item")
-        ET.SubElement(item1, "description").text = "Product A"
-        ET.SubElement(item1, "quantity").text = "2"
-        ET.SubElement(item1, "unit_price").text = "100.00"
+        try:
+            import zstandard
+            self._zstd = zstandard
+            self.codec = self.CODEC_ZSTD
+        except ImportError:
+            self._zstd = None
+            self.codec = self.CODEC_ZLIB
         
-        item2 = ET.SubElement(items, "item")
-        ET.SubElement(item2, "description").text = "Product B"
-        ET.SubElement(item2, "quantity").text = "1"
-        ET.SubElement(item2, "unit_price").text = "150.00"
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self._index.execute("PRAGMA journal_mode=WAL")
+        self._index.execute("""
+            CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY,
+                chave_acesso TEXT,
+                numero_nf TEXT,
+                segment INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                archived_at TEXT
+            )
+        """)
+        self._index.execute("CREATE INDEX IF NOT EXISTS records_chave ON records (chave_acesso)")
+        self._index.execute("CREATE INDEX IF NOT EXISTS records_numero ON records (numero_nf)")
+        self._index.commit()
         
-        taxes = ET.SubElement(root, "taxes")
-        ET.SubElement(taxes, "ICMS").text = "63.00"
-        ET.SubElement(taxes, "IPI").text = "52.50"
-        ET.SubElement(taxes, "PIS").text = "5.78"
-        ET.SubElement(taxes, "COFINS").text = "26.60"
+        self._dictionaries: Dict[int, bytes] = {}
+        for name in sorted(os.listdir(directory)):
+            match = re.match(r'^dict-(\d+)\.bin$', name)
+            if match:
+                with open(os.path.join(directory, name), 'rb') as f:
+                    self._dictionaries[int(match.group(1))] = f.read()
+        self._current_dict = max(self._dictionaries, default=0)
+        self._training_attempted = bool(self._dictionaries)
+        self._compressors: Dict[Tuple[int, int], object] = {}
+        self._decompressors: Dict[Tuple[int, int], object] = {}
+        self._readers: Dict[int, object] = {}
+        self._open_current_segment()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment:06d}.dat")
+
+    def _open_current_segment(self):
+        # Após uma queda de energia o segmento pode ter ficado menor que o índice:
+        # registros que não chegaram ao disco saem do índice, senão suas posições
+        # seriam reutilizadas pelos próximos registros
+        for segment, end in self._index.execute("SELECT segment, MAX(offset + length) FROM records GROUP BY segment").fetchall():
+            path = self._segment_path(segment)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size < end:
+                self._index.execute("DELETE FROM records WHERE segment = ? AND offset + length > ?", (segment, size))
+        self._index.commit()
         
-        ET.SubElement(root, "total").text = "350.00"
+        row = self._index.execute("SELECT segment, MAX(offset + length) FROM records "
+                                  "WHERE segment = (SELECT MAX(segment) FROM records)").fetchone()
+        self._segment = row[0] or 1
+        end = row[1] or 0
+        # Descarta o que foi gravado sem entrar no índice: segmentos abertos numa
+        # virada logo antes de uma queda e o final incompleto do segmento atual
+        for name in os.listdir(self.directory):
+            match = re.match(r'^segment-(\d+)\.dat$', name)
+            if match and int(match.group(1)) > self._segment:
+                os.remove(os.path.join(self.directory, name))
+        self._writer = open(self._segment_path(self._segment), 'ab')
+        if self._writer.tell() > end:
+            self._writer.truncate(end)
+            self._writer.seek(end)
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+            self._index.close()
+
+    def _encode_blob(self, xml_data: bytes, result: Dict) -> bytes:
+        return struct.pack('<I', len(xml_data)) + xml_data + json.dumps(result, ensure_ascii=False).encode('utf-8')
+
+    def _decode_blob(self, blob: bytes) -> Dict:
+        (xml_length,) = struct.unpack_from('<I', blob)
+        return {
+            "xml": blob[4:4 + xml_length],
+            "result": json.loads(blob[4 + xml_length:].decode('utf-8'))
+        }
+
+    def _compress(self, blob: bytes, dict_no: int) -> bytes:
+        if self.codec == self.CODEC_ZSTD:
+            key = (self.codec, dict_no)
+            if key not in self._compressors:
+                dict_data = self._zstd.ZstdCompressionDict(self._dictionaries[dict_no]) if dict_no else None
+                self._compressors[key] = self._zstd.ZstdCompressor(level=self.compression_level, dict_data=dict_data)
+            return self._compressors[key].compress(blob)
+        if dict_no:
+            compressor = zlib.compressobj(self.compression_level, zdict=self._dictionaries[dict_no])
+        else:
+            compressor = zlib.compressobj(self.compression_level)
+        return compressor.compress(blob) + compressor.flush()
+
+    def _decompress(self, payload: bytes, codec: int, dict_no: int) -> bytes:
+        if codec == self.CODEC_ZSTD:
+            if self._zstd is None:
+                raise RuntimeError("Registro comprimido com zstd; instale o pacote zstandard")
+            key = (codec, dict_no)
+            if key not in self._decompressors:
+                dict_data = self._zstd.ZstdCompressionDict(self._dictionaries[dict_no]) if dict_no else None
+                self._decompressors[key] = self._zstd.ZstdDecompressor(dict_data=dict_data)
+            return self._decompressors[key].decompress(payload)
+        if dict_no:
+            decompressor = zlib.decompressobj(zdict=self._dictionaries[dict_no])
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(payload) + decompressor.flush()
+
+    def train_dictionary(self, samples: Optional[List[bytes]] = None) -> int:
+        """Treina um novo dicionário com as amostras (ou com os registros já arquivados)."""
+        if samples is None:
+            samples = [self._encode_blob(record["xml"], record["result"]) for record in self.scan()]
+        if self.codec == self.CODEC_ZSTD:
+            dict_data = self._zstd.train_dictionary(self.dict_size, samples).as_bytes()
+        else:
+            # O zlib usa como dicionário um trecho de conteúdo típico (até 32 KB)
+            dict_data = b''.join(samples[:64])[-32 * 1024:]
         
-        return ET.tostring(root, encoding='unicode')
+        with self._lock:
+            dict_no = max(self._dictionaries, default=0) + 1
+            with open(os.path.join(self.directory, f"dict-{dict_no:04d}.bin"), 'wb') as f:
+                f.write(dict_data)
+            self._dictionaries[dict_no] = dict_data
+            self._current_dict = dict_no
+        return dict_no
 
-    # If file is provided, read and analyze it
-    if args.file:
-        try:
-            with open(args.file, 'r') as f:
-                invoice_xml = f.read()
-        except FileNotFoundError:
-            print(f"Erro: Arquivo {args.file} não encontrado")
-            sys.exit(1)
-    else:
-        # Use sample invoice if no file provided
-        invoice_xml = generate_sample_xml()
-
-    # Initialize system
-    system = NFSystem()
-    
-    while True:
-        choice = show_menu()
-        
-        if choice == "1":
-            success, message = system.select_file()
-            print(f"\n{message}\n")
-            
-        elif choice == "2":
-            success, message = system.analyze_invoice()
-            print(f"\n{message}")
-            if success:
-                print("\nRelatório de Auditoria:")
-                print(system.current_result)
-                print("\nAnálise da IA:")
-                print(system.analysis_result)
-            print()
-            
-        elif choice == "3":
-            success, message = system.save_results()
-            print(f"\n{message}\n")
-            
-        elif choice == "4":
-            success, message = system.send_email()
-            print(f"\n{message}\n")
+    def append(self, xml_data: Union[str, bytes], result: Dict) -> int:
+        """Arquiva o XML original e o resultado da auditoria; devolve o id do registro."""
+        if isinstance(xml_data, str):
+            xml_data = xml_data.encode('utf-8')
+        blob = self._encode_blob(xml_data, result)
+        
+        with self._lock:
+            dict_no = self._current_dict
+            payload = self._compress(blob, dict_no)
+            if self._writer.tell() + self._RECORD_HEADER.size + len(payload) > self.segment_size and self._writer.tell() > 0:
+                self._writer.close()
+                self._segment += 1
+                self._writer = open(self._segment_path(self._segment), 'ab')
             
-        elif choice == "5":
-            print("\nEncerrando o sistema...")
-            sys.exit(0)
+            offset = self._writer.tell()
+            self._writer.write(self._RECORD_HEADER.pack(self._MAGIC, self.codec, dict_no, len(payload), zlib.crc32(blob)))
+            self._writer.write(payload)
+            self._writer.flush()
+            # O registro precisa estar no disco antes de o índice apontar para ele
+            os.fsync(self._writer.fileno())
             
+            cursor = self._index.execute(
+                "INSERT INTO records (chave_acesso, numero_nf, segment, offset, length, archived_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (result.get('chave_acesso'), result.get('numero_nf'), self._segment, offset,
+                 self._RECORD_HEADER.size + len(payload), datetime.now().isoformat())
+            )
+            self._index.commit()
+            record_id = cursor.lastrowid
+            should_train = bool(self.train_after) and not self._training_attempted and record_id >= self.train_after
+            if should_train:
+                self._training_attempted = True
+        
+        if should_train:
+            try:
+                self.train_dictionary()
+            except Exception:
+                pass  # Poucas amostras ou amostras pequenas demais: segue sem dicionário
+        return record_id
+
+    def _read_record(self, segment: int, offset: int, length: int) -> Dict:
+        with self._lock:
+            reader = self._readers.get(segment)
+            if reader is None:
+                reader = self._readers[segment] = open(self._segment_path(segment), 'rb')
+            reader.seek(offset)
+            data = reader.read(length)
+        magic, codec, dict_no, payload_length, crc = self._RECORD_HEADER.unpack_from(data)
+        if magic != self._MAGIC:
+            raise ValueError(f"Registro corrompido no segmento {segment}, posição {offset}")
+        blob = self._decompress(data[self._RECORD_HEADER.size:], codec, dict_no)
+        if zlib.crc32(blob) != crc:
+            raise ValueError(f"CRC inválido no segmento {segment}, posição {offset}")
+        return self._decode_blob(blob)
+
+    def get(self, chave_acesso: Optional[str] = None, numero_nf: Optional[str] = None) -> Optional[Dict]:
+        """Lê o registro mais recente pela chave de acesso ou pelo número da NF."""
+        if chave_acesso:
+            query, value = "chave_acesso = ?", chave_acesso
+        elif numero_nf:
+            query, value = "numero_nf = ?", numero_nf
         else:
-            print("\nOpção inválida. Por favor, escolha uma opção válida.\n")
+            raise ValueError("Informe a chave de acesso ou o número da NF")
+        with self._lock:
+            row = self._index.execute(
+                f"SELECT segment, offset, length FROM records WHERE {query} ORDER BY id DESC LIMIT 1", (value,)
+            ).fetchone()
+        return self._read_record(*row) if row else None
+
+    def scan(self):
+        """Percorre todos os registros em ordem, lendo os segmentos sequencialmente."""
+        with self._lock:
+            self._writer.flush()
+            rows = self._index.execute("SELECT segment, MAX(offset + length) FROM records GROUP BY segment ORDER BY segment").fetchall()
+        for segment, end in rows:
+            with open(self._segment_path(segment), 'rb') as f:
+                while f.tell() < end:
+                    header = f.read(self._RECORD_HEADER.size)
+                    magic, codec, dict_no, payload_length, crc = self._RECORD_HEADER.unpack(header)
+                    if magic != self._MAGIC:
+                        raise ValueError(f"Registro corrompido no segmento {segment}")
+                    blob = self._decompress(f.read(payload_length), codec, dict_no)
+                    if zlib.crc32(blob) != crc:
+                        raise ValueError(f"CRC inválido no segmento {segment}")
+                    yield self._decode_blob(blob)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sistema de Análise de Notas Fiscais")
+    parser.add_argument("--test", action="store_true", help="Executa os testes")
+    parser.add_argument("--file", help="Arquivo XML da nota fiscal")
+    parser.add_argument("--watch", nargs="+", metavar="DIR", help="Monitora diretórios e audita novos XMLs (sem interface gráfica)")
+    parser.add_argument("--output", default="resultados", help="Diretório de saída do modo --watch")
+    parser.add_argument("--workers", type=int, default=4, help="Número de auditorias simultâneas no modo --watch")
+    parser.add_argument("--poll", action="store_true", help="Usa consulta periódica em vez de inotify")
+    parser.add_argument("--process-existing", action="store_true", help="Audita também os XMLs já presentes ao iniciar")
+    parser.add_argument("--schema-dir", metavar="DIR", help="Valida cada XML contra os XSDs oficiais da NF-e em DIR")
+    parser.add_argument("--verify-signatures", action="store_true", help="Verifica a assinatura digital de cada XML")
+    parser.add_argument("--trusted-certs", nargs="+", metavar="PEM", help="Certificados das ACs confiáveis para validar a cadeia do emitente")
+    parser.add_argument("--purchase-orders", metavar="ARQUIVO", help="Base de pedidos de compra (CSV ou SQLite) para confronto com as notas")
+    parser.add_argument("--purchase-order-state", metavar="DB", help="Quantidades já faturadas por pedido (SQLite), compartilhadas entre processos e execuções")
+    parser.add_argument("--price-history", metavar="DB", help="Histórico de preços (SQLite) para detectar itens acima do padrão do fornecedor")
+    parser.add_argument("--reset-price", nargs=2, metavar=("CNPJ", "CODIGO"), help="Zera o histórico de preços de um produto do fornecedor (reajuste aceito)")
+    parser.add_argument("--queue", metavar="DB", help="Fila durável de auditorias (SQLite); retoma de onde parou")
+    parser.add_argument("--enqueue", nargs="+", metavar="CAMINHO", help="Adiciona arquivos XML (ou diretórios) à fila")
+    parser.add_argument("--processes", type=int, default=0, help="Número de processos que consomem a fila")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Tentativas por arquivo antes da fila de mortos")
+    parser.add_argument("--archive", metavar="DIR", help="Arquivo compacto de XMLs e resultados (usado por --watch e --reaudit)")
+    parser.add_argument("--reaudit", action="store_true", help="Audita novamente todas as notas do arquivo compacto")
+    parser.add_argument("--profile", metavar="DIR", help="Ativa o modo de perfil e grava os perfis das notas atípicas em DIR")
+    parser.add_argument("--profile-percentile", type=float, default=95.0, help="Percentil de latência/memória que dispara a captura do perfil")
+    parser.add_argument("--profile-memory", action="store_true", help="Mede também a memória de cada nota com tracemalloc")
+    parser.add_argument("--profile-deterministic", action="store_true", help="Roda toda nota sob cProfile e grava também o .pstats das atípicas")
+    args = parser.parse_args()
+    
+    if args.test:
+        import unittest
+        import test_nf
+        unittest.main(module=test_nf, argv=[sys.argv[0]])
+    
+    if args.reset_price:
+        if not args.price_history:
+            parser.error("--reset-price exige --price-history")
+        price_history = PriceHistory(args.price_history, shared=True)
+        found = price_history.reset(*args.reset_price)
+        price_history.close()
+        print("Histórico de preços zerado." if found else "Nenhum histórico encontrado para esse fornecedor e produto.")
+        sys.exit(0)
+    
+    profiler = None
+    if args.profile:
+        profiler = InvoiceProfiler(args.profile, percentile=args.profile_percentile, track_memory=args.profile_memory,
+                                   deterministic=args.profile_deterministic)
+    
+    audit_options = {
+        "schema_dir": args.schema_dir,
+        "verify_signatures": args.verify_signatures,
+        "trusted_certs": args.trusted_certs,
+        "purchase_orders": args.purchase_orders,
+        # Os processos da fila só enxergam o faturamento uns dos outros por um estado em disco
+        "purchase_order_state": args.purchase_order_state or (args.queue if args.purchase_orders else None),
+        "price_history": args.price_history,
+    }
+    
+    if args.queue:
+        queue = SQLiteJobQueue(args.queue, max_attempts=args.max_attempts)
+        if args.enqueue:
+            file_paths = []
+            for path in args.enqueue:
+                if os.path.isdir(path):
+                    file_paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                                      if name.lower().endswith('.xml'))
+                else:
+                    file_paths.append(path)
+            print(f"{queue.enqueue(file_paths)} arquivo(s) adicionado(s) à fila.")
+        if args.processes > 0:
+            run_queue_workers(args.queue, args.processes, audit_options=audit_options, max_attempts=args.max_attempts)
+        counts = queue.counts()
+        print(f"Fila: {counts['pending']} pendente(s), {counts['running']} em execução, "
+              f"{counts['done']} concluída(s), {counts['dead']} com falha definitiva.")
+        queue.close()
+        sys.exit(0)
+    
+    archive = InvoiceArchive(args.archive) if args.archive else None
+    
+    if archive is not None and args.reaudit:
+        nf_system = NFSystem()
+        nf_system.profiler = profiler
+        nf_system.configure(**audit_options)
+        status_counts: Dict[str, int] = {}
+        for record in archive.scan():
+            try:
+                _, audit_results, _ = nf_system._process_xml(decode_xml_bytes(record["xml"]),
+                                                             record["result"].get('arquivo', ''))
+                status = audit_results['status']
+            except Exception:
+                status = 'ERRO'
+            status_counts[status] = status_counts.get(status, 0) + 1
+        archive.close()
+        nf_system.close()
+        print("Reauditoria: " + ", ".join(f"{status}: {total}" for status, total in sorted(status_counts.items())))
+        sys.exit(0)
+    
+    if args.watch:
+        nf_system = NFSystem()
+        nf_system.profiler = profiler
+        nf_system.configure(**audit_options)
+        watcher = InvoiceWatcher(args.watch, args.output, workers=args.workers,
+                                 use_inotify=not args.poll, process_existing=args.process_existing,
+                                 nf_system=nf_system, archive=archive)
+        print(f"Monitorando {', '.join(args.watch)} (Ctrl+C para encerrar)...")
+        watcher.run_forever()
+        nf_system.close()
+        if archive is not None:
+            archive.close()
+        print(f"Encerrado: {watcher.stats['auditadas']} nota(s) auditada(s), {watcher.stats['erros']} erro(s).")
+        if profiler is not None:
+            print(f"Perfis capturados: {profiler.stats['capturadas']} de {profiler.stats['medidas']} nota(s).")
+            profiler.close()
+        sys.exit(0)
+    
+    app = NFSystemGUI()
+    app.nf_system.profiler = profiler
+    app.nf_system.configure(**audit_options)
+    if args.file:
+        app.open_file(args.file)
+    app.run()
+    app.nf_system.close()
+    sys.exit(0)
@@ -1,6 +1,52 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
 import unittest
 import xml.etree.ElementTree as ET
-from nf import InvoiceValidator, InvoiceAuditTool
+from unittest import mock
+import nf
+from nf import InvoiceValidator, InvoiceAuditTool, NFSystem
+
+try:
+    import lxml  # noqa: F401
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+try:
+    import cryptography  # noqa: F401
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+
+def build_nfe_xml(numero_nf="1001", emit_cnpj="11222333000181", dest_cnpj="11444777000161",
+                  items=(("P001", "Produto A", 2, 50.00),), valor_total=None,
+                  chave="35240111222333000181550010000010011000000012", ncm="84713012", cfop="5102", pedido=None):
+    """Monta um XML de NF-e mínimo para os testes."""
+    dets = []
+    for n, (codigo, descricao, quantidade, valor_unitario) in enumerate(items, start=1):
+        dets.append(
+            f'<det nItem="{n}"><prod><cProd>{codigo}</cProd><xProd>{descricao}</xProd>'
+            f'<NCM>{ncm}</NCM><CFOP>{cfop}</CFOP>'
+            f'<qCom>{quantidade}</qCom><vUnCom>{valor_unitario:.2f}</vUnCom>'
+            f'<vProd>{quantidade * valor_unitario:.2f}</vProd></prod></det>'
+        )
+    if valor_total is None:
+        valor_total = sum(quantidade * valor_unitario for _, _, quantidade, valor_unitario in items)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00"><NFe>'
+        f'<infNFe versao="4.00" Id="NFe{chave}">'
+        f'<ide><nNF>{numero_nf}</nNF><dhEmi>2024-01-15T10:00:00-03:00</dhEmi></ide>'
+        f'<emit><CNPJ>{emit_cnpj}</CNPJ><xNome>Fornecedor Teste</xNome></emit>'
+        f'<dest><CNPJ>{dest_cnpj}</CNPJ><xNome>Cliente Teste</xNome></dest>'
+        + "".join(dets) +
+        f'<total><ICMSTot><vNF>{valor_total:.2f}</vNF></ICMSTot></total>'
+        + (f'<compra><xPed>{pedido}</xPed></compra>' if pedido else '') +
+        '</infNFe></NFe></nfeProc>'
+    )
 
 class TestInvoiceValidator(unittest.TestCase):
     def setUp(self):
@@ -52,5 +98,1155 @@ class TestInvoiceValidator(unittest.TestCase):
         result = self.audit_tool._run(invalid_xml)
         self.assertIn("Error", result)
 
+class TestBatchAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.system = NFSystem()
+        self.system.triage = None
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for numero_nf in ("1", "2", "3"):
+            path = os.path.join(self.tmpdir.name, f"nf_{numero_nf}.xml")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf=numero_nf))
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _response(self, ids, resumos=None):
+        resumos = resumos or [f"ok {i}" for i in ids]
+        return mock.Mock(text=json.dumps([
+            {"id": i, "resumo": resumo, "avaliacao_risco": "baixo", "acoes_recomendadas": []}
+            for i, resumo in zip(ids, resumos)
+        ]))
+
+    def test_batch_single_request(self):
+        with mock.patch.object(nf.model, "generate_content", return_value=self._response(["1", "2", "3"])) as gen:
+            success, _ = self.system.analyze_invoices(self.files)
+        self.assertTrue(success)
+        self.assertEqual(gen.call_count, 1)
+        self.assertEqual(self.system.batch_results[self.files[1]]["resumo"], "ok 2")
+        self.assertEqual(self.system.batch_results[self.files[1]]["numero_nf"], "2")
+
+    def test_batch_size_splits_requests(self):
+        self.system.batch_size = 2
+        responses = [self._response(["1", "2"]), self._response(["1"], ["ok 3"])]
+        with mock.patch.object(nf.model, "generate_content", side_effect=responses) as gen:
+            self.system.analyze_invoices(self.files)
+        self.assertEqual(gen.call_count, 2)
+        self.assertEqual(set(self.system.batch_results), set(self.files))
+        self.assertEqual(self.system.batch_results[self.files[2]]["resumo"], "ok 3")
+
+    def test_fallback_to_individual_requests(self):
+        responses = [mock.Mock(text="isto não é JSON")] + [self._response(["1"], [f"ok {i}"]) for i in ("1", "2", "3")]
+        with mock.patch.object(nf.model, "generate_content", side_effect=responses) as gen:
+            self.system.analyze_invoices(self.files)
+        self.assertEqual(gen.call_count, 4)
+        self.assertEqual(self.system.batch_results[self.files[2]]["resumo"], "ok 3")
+
+    def test_api_error_does_not_fall_back(self):
+        with mock.patch.object(nf.model, "generate_content", side_effect=RuntimeError("429 Quota exceeded")) as gen:
+            success, _ = self.system.analyze_invoices(self.files)
+        self.assertEqual(gen.call_count, 1)
+        self.assertTrue(success)
+        self.assertEqual(set(self.system.batch_results), set(self.files))
+        self.assertTrue(all("429" in result["erro"] for result in self.system.batch_results.values()))
+
+    def test_same_invoice_number_from_different_suppliers(self):
+        other = os.path.join(self.tmpdir.name, "outro_fornecedor.xml")
+        with open(other, 'w', encoding='utf-8') as f:
+            f.write(build_nfe_xml(numero_nf="1", emit_cnpj="11444777000161", dest_cnpj="11222333000181",
+                                  chave="35240111444777000161550010000000011000000011"))
+        with mock.patch.object(nf.model, "generate_content", return_value=self._response(["1", "2"])) as gen:
+            success, message = self.system.analyze_invoices([self.files[0], other])
+        self.assertEqual(gen.call_count, 1)
+        self.assertIn("2 nota(s) analisada(s)", message)
+        self.assertEqual(self.system.batch_results[other]["resumo"], "ok 2")
+        self.assertEqual(self.system.batch_results[other]["numero_nf"], "1")
+
+    def test_parse_batch_response_missing_invoice(self):
+        with self.assertRaises(ValueError):
+            self.system._parse_batch_response(self._response(["1"]).text, ["1", "2"])
+
+class TestRiskTriage(unittest.TestCase):
+    def setUp(self):
+        self.audit_tool = InvoiceAuditTool()
+        self.validator = InvoiceValidator()
+        self.triage = nf.RiskTriage()
+
+    def _score(self, xml_string):
+        invoice = self.audit_tool._xml_to_dict(xml_string)
+        audit_results = self.audit_tool._perform_audit(invoice, self.validator)
+        return self.triage.score(invoice, audit_results) + (audit_results,)
+
+    def test_clean_invoice_is_low_risk(self):
+        score, _, audit_results = self._score(build_nfe_xml())
+        self.assertFalse(self.triage.is_high_risk(score, audit_results))
+
+    def test_high_value_invoice_goes_to_model(self):
+        score, reasons, audit_results = self._score(build_nfe_xml(items=(("P001", "Servidor", 2, 40000.00),)))
+        self.assertEqual(audit_results["status"], "PASSED")
+        self.assertTrue(self.triage.is_high_risk(score, audit_results))
+        self.assertTrue(any("valor total acima" in reason for reason in reasons))
+
+    def test_threshold_is_configurable(self):
+        self.triage.high_value = 50.00
+        score, _, audit_results = self._score(build_nfe_xml())
+        self.assertTrue(self.triage.is_high_risk(score, audit_results))
+        self.triage.threshold = 1.5
+        self.assertFalse(self.triage.is_high_risk(score, audit_results))
+
+    def test_failed_audit_is_never_canned(self):
+        score, _, audit_results = self._score(build_nfe_xml(emit_cnpj=""))
+        self.assertEqual(audit_results["status"], "FAILED")
+        self.assertLess(score, self.triage.threshold)
+        self.assertTrue(self.triage.is_high_risk(score, audit_results))
+        with self.assertRaises(ValueError):
+            self.triage.canned_analysis(audit_results, score, [])
+
+    def test_low_risk_invoice_skips_model(self):
+        system = NFSystem()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            clean = os.path.join(tmpdir, "limpa.xml")
+            risky = os.path.join(tmpdir, "suspeita.xml")
+            with open(clean, 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf="1"))
+            with open(risky, 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf="2", valor_total=999.00))
+            response = mock.Mock(text=json.dumps([
+                {"id": "1", "resumo": "suspeita", "avaliacao_risco": "alto", "acoes_recomendadas": []}
+            ]))
+            with mock.patch.object(nf.model, "generate_content", return_value=response) as gen:
+                system.analyze_invoices([clean, risky])
+        self.assertEqual(gen.call_count, 1)
+        self.assertTrue(system.batch_results[clean]["triagem_local"])
+        self.assertEqual(system.batch_results[risky]["resumo"], "suspeita")
+        self.assertEqual(system.triage_stats["evitadas_ia"], 1)
+        self.assertEqual(system.triage_stats["enviadas_ia"], 1)
+
+class TestInvoiceWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.inbox = os.path.join(self.tmpdir.name, "entrada")
+        self.outbox = os.path.join(self.tmpdir.name, "saida")
+        os.makedirs(self.inbox)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _wait_for_results(self, watcher, count, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if watcher.stats["auditadas"] + watcher.stats["erros"] >= count:
+                return
+            time.sleep(0.05)
+        self.fail("Timeout aguardando auditoria dos arquivos monitorados")
+
+    def _run_watcher(self, use_inotify):
+        with open(os.path.join(self.inbox, "antiga.xml"), 'w', encoding='utf-8') as f:
+            f.write(build_nfe_xml(numero_nf="1"))
+        watcher = nf.InvoiceWatcher([self.inbox], self.outbox, workers=2, settle_time=0.1,
+                                    poll_interval=0.05, use_inotify=use_inotify)
+        watcher.start()
+        try:
+            # Simula uma gravação em duas etapas; o arquivo só deve ser auditado completo
+            path = os.path.join(self.inbox, "nova.xml")
+            content = build_nfe_xml(numero_nf="2")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content[:40])
+                f.flush()
+                time.sleep(0.03)
+                f.write(content[40:])
+            self._wait_for_results(watcher, 1)
+        finally:
+            watcher.stop()
+        
+        self.assertEqual(watcher.stats, {"auditadas": 1, "erros": 0})
+        with open(os.path.join(self.outbox, "resultados.jsonl"), encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record["numero_nf"] for record in records], ["2"])
+        self.assertTrue(os.path.exists(os.path.join(self.outbox, "nova.txt")))
+        return watcher
+
+    def test_watch_with_polling(self):
+        self._run_watcher(use_inotify=False)
+
+    def test_watch_with_inotify(self):
+        self._run_watcher(use_inotify=True)
+
+    def test_inotify_overflow_is_flagged(self):
+        inotify = nf._Inotify.__new__(nf._Inotify)
+        inotify.fd, write_fd = os.pipe()
+        inotify.watches = {1: self.inbox}
+        inotify.overflowed = False
+        try:
+            os.write(write_fd, nf._Inotify._EVENT_HEADER.pack(-1, nf._Inotify.IN_Q_OVERFLOW, 0, 0))
+            self.assertEqual(inotify.read_paths(timeout=1.0), [])
+            self.assertTrue(inotify.overflowed)
+        finally:
+            inotify.close()
+            os.close(write_fd)
+
+    def test_overflow_triggers_reconciliation(self):
+        watcher = nf.InvoiceWatcher([self.inbox], self.outbox, workers=1, settle_time=0.1,
+                                    poll_interval=0.05, use_inotify=True)
+        watcher.start()
+        if watcher.mode != "inotify":
+            watcher.stop()
+            self.skipTest("inotify não disponível")
+        try:
+            # Eventos perdidos: nenhum caminho chega pelo inotify, só o aviso de estouro
+            watcher._inotify.read_paths = lambda timeout: time.sleep(timeout) or []
+            time.sleep(0.2)  # deixa terminar a leitura que já estava em andamento
+            with open(os.path.join(self.inbox, "perdida.xml"), 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf="3"))
+            watcher._inotify.overflowed = True
+            self._wait_for_results(watcher, 1)
+        finally:
+            watcher.stop()
+        self.assertEqual(watcher.stats, {"auditadas": 1, "erros": 0})
+
+    def _survives_directory_removal(self, use_inotify):
+        watcher = nf.InvoiceWatcher([self.inbox], self.outbox, workers=1, settle_time=0.1,
+                                    poll_interval=0.05, use_inotify=use_inotify)
+        watcher.start()
+        try:
+            # Compartilhamento fora do ar por um instante
+            os.rmdir(self.inbox)
+            time.sleep(0.3)
+            os.makedirs(self.inbox)
+            time.sleep(0.2)
+            with open(os.path.join(self.inbox, "depois.xml"), 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf="6"))
+            self._wait_for_results(watcher, 1)
+            self.assertTrue(watcher._thread.is_alive())
+        finally:
+            watcher.stop()
+        self.assertEqual(watcher.stats, {"auditadas": 1, "erros": 0})
+
+    def test_polling_survives_directory_removal(self):
+        self._survives_directory_removal(use_inotify=False)
+
+    def test_inotify_survives_directory_removal(self):
+        self._survives_directory_removal(use_inotify=True)
+
+    def test_scan_skips_file_renamed_during_listing(self):
+        with open(os.path.join(self.inbox, "fica.xml"), 'w', encoding='utf-8') as f:
+            f.write(build_nfe_xml())
+        vanished = mock.Mock(path=os.path.join(self.inbox, "temp.xml"))
+        vanished.name = "temp.xml"
+        vanished.is_file.return_value = True
+        vanished.stat.side_effect = FileNotFoundError
+        real_scandir = os.scandir
+
+        class Listing:
+            def __init__(self, directory):
+                self._it = real_scandir(directory)
+
+            def __enter__(self):
+                return [vanished] + list(self._it)
+
+            def __exit__(self, *exc):
+                self._it.close()
+
+        watcher = nf.InvoiceWatcher([self.inbox], self.outbox, use_inotify=False)
+        with mock.patch.object(nf.os, "scandir", Listing):
+            paths = [path for path, _ in watcher._scan()]
+        self.assertEqual(paths, [os.path.join(self.inbox, "fica.xml")])
+
+    def test_same_name_in_two_directories_keeps_both_reports(self):
+        other = os.path.join(self.tmpdir.name, "filial")
+        os.makedirs(other)
+        for directory, numero_nf in ((self.inbox, "4"), (other, "5")):
+            with open(os.path.join(directory, "nota.xml"), 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf=numero_nf))
+        watcher = nf.InvoiceWatcher([self.inbox, other], self.outbox, workers=2, settle_time=0.05,
+                                    poll_interval=0.05, use_inotify=False, process_existing=True)
+        watcher.start()
+        try:
+            self._wait_for_results(watcher, 2)
+        finally:
+            watcher.stop()
+        with open(os.path.join(self.outbox, "resultados.jsonl"), encoding='utf-8') as f:
+            report_paths = {json.loads(line)["numero_nf"]: json.loads(line)["relatorio"] for line in f}
+        self.assertEqual(len(set(report_paths.values())), 2)
+        for numero_nf, report_path in report_paths.items():
+            with open(report_path, encoding='utf-8') as f:
+                self.assertIn(numero_nf, f.read())
+
+class TestInvoiceProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_only_outliers_are_captured(self):
+        profiler = nf.InvoiceProfiler(self.tmpdir.name, percentile=90.0, min_samples=5, deterministic=True)
+        calls = []
+        
+        def slow_invoice():
+            calls.append(1)
+            time.sleep(0.05)
+        
+        # Latência fixa de 1 ms para as notas normais, evitando variação do relógio
+        with mock.patch.object(nf.time, "perf_counter", side_effect=[0.0, 0.001] * 10):
+            for n in range(10):
+                self.assertEqual(profiler.run(f"rapida_{n}", lambda: sum(range(100))), 4950)
+        profiler.run("lenta", slow_invoice)
+        profiler.close()
+        
+        # O perfil é da própria execução lenta, sem reprocessar a nota
+        self.assertEqual(calls, [1])
+        self.assertEqual(profiler.stats, {"medidas": 11, "capturadas": 1})
+        capture = profiler.captures[0]
+        self.assertEqual(capture["nota"], "lenta")
+        self.assertTrue(os.path.exists(capture["pstats"]))
+        with open(capture["collapsed"], encoding='utf-8') as f:
+            self.assertIn("slow_invoice", f.read())
+
+    def test_sampling_is_the_default(self):
+        profiler = nf.InvoiceProfiler(self.tmpdir.name, min_samples=1, sample_interval=0.001)
+        profiler.run("rapida", lambda: None)
+        profiler.run("lenta", lambda: time.sleep(0.05))
+        profiler.close()
+        self.assertEqual(len(profiler.captures), 1)
+        self.assertNotIn("pstats", profiler.captures[0])
+        with open(profiler.captures[0]["collapsed"], encoding='utf-8') as f:
+            self.assertIn("<lambda>", f.read())
+
+    def test_short_outlier_is_sampled(self):
+        profiler = nf.InvoiceProfiler(self.tmpdir.name, percentile=90.0, min_samples=5)
+        
+        def short_outlier():
+            time.sleep(0.004)
+        
+        for n in range(10):
+            profiler.run(f"rapida_{n}", lambda: time.sleep(0.0005))
+        profiler.run("lenta", short_outlier)
+        profiler.close()
+        captures = [capture for capture in profiler.captures if capture["nota"] == "lenta"]
+        self.assertEqual(len(captures), 1)
+        with open(captures[0]["collapsed"], encoding='utf-8') as f:
+            self.assertIn("short_outlier", f.read())
+
+    def test_outlier_without_samples_is_not_recorded(self):
+        profiler = nf.InvoiceProfiler(self.tmpdir.name, min_samples=1)
+        with mock.patch.object(profiler._sampler, "start", side_effect=lambda: {}):
+            profiler.run("rapida", lambda: None)
+            profiler.run("lenta", lambda: time.sleep(0.01))
+        profiler.close()
+        self.assertEqual(profiler.captures, [])
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_batch_capture_covers_parse_audit_and_format(self):
+        import pstats
+        system = NFSystem()
+        system.profiler = nf.InvoiceProfiler(self.tmpdir.name, deterministic=True)
+        recorded = []
+        entries = [(build_nfe_xml(numero_nf=str(n)), f"nota_{n}.xml", None) for n in (1, 2)]
+        try:
+            with mock.patch.object(system.profiler, "record", side_effect=lambda label, m: recorded.append((label, m))):
+                outcomes = system._process_xmls(entries)
+        finally:
+            system.profiler.close()
+        self.assertEqual([outcome[1]["status"] for outcome in outcomes], ["PASSED", "PASSED"])
+        self.assertEqual([label for label, _ in recorded], ["nota_1.xml", "nota_2.xml"])
+        functions = {name for _, _, name in pstats.Stats(recorded[0][1].profile).stats}
+        self.assertTrue({"_xml_to_dict", "_perform_audit", "_format_invoice_data"} <= functions)
+
+    def test_profiled_processing_returns_results(self):
+        system = NFSystem()
+        system.profiler = nf.InvoiceProfiler(self.tmpdir.name, min_samples=1, track_memory=True)
+        try:
+            invoice_data, audit_results, formatted = system._process_xml(build_nfe_xml(), "nota.xml")
+        finally:
+            system.profiler.close()
+        self.assertEqual(invoice_data["numero_nf"], "1001")
+        self.assertEqual(audit_results["status"], "PASSED")
+        self.assertIn("DADOS DA NOTA FISCAL", formatted)
+
+TEST_PROC_XSD = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns="http://www.portalfiscal.inf.br/nfe"
+           targetNamespace="http://www.portalfiscal.inf.br/nfe" elementFormDefault="qualified">
+  <xs:element name="nfeProc">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="NFe">
+          <xs:complexType>
+            <xs:sequence>
+              <xs:element name="infNFe">
+                <xs:complexType>
+                  <xs:sequence>
+                    <xs:element name="ide">
+                      <xs:complexType>
+                        <xs:sequence>
+                          <xs:element name="nNF">
+                            <xs:simpleType>
+                              <xs:restriction base="xs:string"><xs:pattern value="[1-9][0-9]{0,8}"/></xs:restriction>
+                            </xs:simpleType>
+                          </xs:element>
+                          <xs:element name="dhEmi" type="xs:string"/>
+                        </xs:sequence>
+                      </xs:complexType>
+                    </xs:element>
+                    <xs:element name="emit" type="xs:anyType"/>
+                    <xs:element name="dest" type="xs:anyType"/>
+                    <xs:element name="det" type="xs:anyType" maxOccurs="990"/>
+                    <xs:element name="total" type="xs:anyType"/>
+                  </xs:sequence>
+                  <xs:anyAttribute processContents="skip"/>
+                </xs:complexType>
+              </xs:element>
+            </xs:sequence>
+          </xs:complexType>
+        </xs:element>
+      </xs:sequence>
+      <xs:anyAttribute processContents="skip"/>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+@unittest.skipUnless(HAS_LXML, "lxml não instalado")
+class TestNFeSchemaValidator(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, "procNFe_v4.00.xsd"), 'w', encoding='utf-8') as f:
+            f.write(TEST_PROC_XSD)
+        self.audit_tool = InvoiceAuditTool(schema_validator=nf.NFeSchemaValidator(self.tmpdir.name))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_valid_invoice_has_no_schema_errors(self):
+        invoice = self.audit_tool._xml_to_dict(build_nfe_xml())
+        self.assertEqual(invoice["erros_schema"], [])
+
+    def test_schema_errors_become_audit_issues(self):
+        invoice = self.audit_tool._xml_to_dict(build_nfe_xml(numero_nf="ABC"))
+        self.assertEqual(len(invoice["erros_schema"]), 1)
+        audit_results = self.audit_tool._perform_audit(invoice, InvoiceValidator())
+        self.assertEqual(audit_results["status"], "FAILED")
+        self.assertTrue(audit_results["issues"][0].startswith("Erro de schema"))
+
+    def test_compiled_schema_is_shared(self):
+        other = nf.NFeSchemaValidator(self.tmpdir.name)
+        self.audit_tool._xml_to_dict(build_nfe_xml())
+        other.validate(build_nfe_xml())
+        path = os.path.join(self.tmpdir.name, "procNFe_v4.00.xsd")
+        self.assertIs(other._load_schema("procNFe_v4.00.xsd"), nf._SCHEMA_CACHE[path])
+
+    def test_unknown_root_element(self):
+        errors = self.audit_tool.schema_validator.validate("<invoice/>")
+        self.assertEqual(len(errors), 1)
+
+def make_test_certificate(common_name, issuer_key=None, issuer_name=None, is_ca=False, cnpj=None,
+                          valid_days=(-3650, 30)):
+    """Gera uma chave RSA e um certificado de teste (autoassinado se não houver emissor).
+    
+    Com `cnpj`, inclui o otherName de e-CNPJ da ICP-Brasil; `valid_days` é o
+    período de validade em dias relativos a hoje.
+    """
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+    
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(issuer_name or name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now + datetime.timedelta(days=valid_days[0]))
+        .not_valid_after(now + datetime.timedelta(days=valid_days[1]))
+        .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True)
+    )
+    if cnpj:
+        other_name = x509.OtherName(x509.ObjectIdentifier("2.16.76.1.3.3"), b"\x04\x0e" + cnpj.encode("ascii"))
+        builder = builder.add_extension(x509.SubjectAlternativeName([other_name]), critical=False)
+    return key, builder.sign(issuer_key or key, hashes.SHA256())
+
+def sign_nfe_xml(xml_string, key, certificate):
+    """Assina o infNFe no padrão da NF-e (enveloped, C14N, RSA-SHA1)."""
+    import base64
+    import hashlib
+    from lxml import etree
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+    
+    ds = "http://www.w3.org/2000/09/xmldsig#"
+    root = etree.fromstring(xml_string.encode('utf-8'))
+    inf_nfe = root.find('.//{http://www.portalfiscal.inf.br/nfe}infNFe')
+    digest = base64.b64encode(hashlib.sha1(etree.tostring(inf_nfe, method='c14n')).digest()).decode()
+    
+    signature = etree.SubElement(inf_nfe.getparent(), f"{{{ds}}}Signature", nsmap={None: ds})
+    signed_info = etree.SubElement(signature, f"{{{ds}}}SignedInfo")
+    etree.SubElement(signed_info, f"{{{ds}}}CanonicalizationMethod",
+                     Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315")
+    etree.SubElement(signed_info, f"{{{ds}}}SignatureMethod", Algorithm=f"{ds}rsa-sha1")
+    reference = etree.SubElement(signed_info, f"{{{ds}}}Reference", URI="#" + inf_nfe.get("Id"))
+    transforms = etree.SubElement(reference, f"{{{ds}}}Transforms")
+    etree.SubElement(transforms, f"{{{ds}}}Transform", Algorithm=f"{ds}enveloped-signature")
+    etree.SubElement(transforms, f"{{{ds}}}Transform", Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315")
+    etree.SubElement(reference, f"{{{ds}}}DigestMethod", Algorithm=f"{ds}sha1")
+    etree.SubElement(reference, f"{{{ds}}}DigestValue").text = digest
+    
+    signature_value = key.sign(etree.tostring(signed_info, method='c14n'), padding.PKCS1v15(), hashes.SHA1())
+    etree.SubElement(signature, f"{{{ds}}}SignatureValue").text = base64.b64encode(signature_value).decode()
+    x509_data = etree.SubElement(etree.SubElement(signature, f"{{{ds}}}KeyInfo"), f"{{{ds}}}X509Data")
+    etree.SubElement(x509_data, f"{{{ds}}}X509Certificate").text = base64.b64encode(
+        certificate.public_bytes(serialization.Encoding.DER)).decode()
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8').decode('utf-8')
+
+@unittest.skipUnless(HAS_LXML and HAS_CRYPTOGRAPHY, "lxml/cryptography não instalados")
+class TestNFeSignatureVerifier(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ca_key, cls.ca_cert = make_test_certificate("AC Teste", is_ca=True)
+        cls.key, cls.cert = make_test_certificate("Emitente Teste", cls.ca_key, cls.ca_cert.subject,
+                                                  cnpj="11222333000181")
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.verifier = nf.NFeSignatureVerifier()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write_ca(self):
+        from cryptography.hazmat.primitives import serialization
+        path = os.path.join(self.tmpdir.name, "ac.pem")
+        with open(path, 'wb') as f:
+            f.write(self.ca_cert.public_bytes(serialization.Encoding.PEM))
+        return path
+
+    def test_valid_signature(self):
+        self.assertEqual(self.verifier.verify(sign_nfe_xml(build_nfe_xml(), self.key, self.cert)), [])
+
+    def test_tampered_invoice_fails_digest(self):
+        signed = sign_nfe_xml(build_nfe_xml(), self.key, self.cert)
+        errors = self.verifier.verify(signed.replace("<vNF>100.00</vNF>", "<vNF>10.00</vNF>"))
+        self.assertEqual(len(errors), 1)
+        self.assertIn("Digest", errors[0])
+
+    def test_missing_signature(self):
+        self.assertEqual(self.verifier.verify(build_nfe_xml()), ["Assinatura digital ausente"])
+
+    def test_certificate_is_decoded_once(self):
+        signed = sign_nfe_xml(build_nfe_xml(), self.key, self.cert)
+        with mock.patch.object(self.verifier._x509, "load_der_x509_certificate",
+                               wraps=self.verifier._x509.load_der_x509_certificate) as load:
+            nf._CERTIFICATE_CACHE.clear()
+            self.verifier.verify(signed)
+            self.verifier.verify(signed)
+        self.assertEqual(load.call_count, 1)
+
+    def test_chain_validation(self):
+        signed = sign_nfe_xml(build_nfe_xml(), self.key, self.cert)
+        trusted = nf.NFeSignatureVerifier([self._write_ca()])
+        self.assertEqual(trusted.verify(signed), [])
+        
+        other_key, other_cert = make_test_certificate("Emitente Desconhecido", cnpj="11222333000181")
+        errors = trusted.verify(sign_nfe_xml(build_nfe_xml(), other_key, other_cert))
+        self.assertEqual(errors, ["Cadeia do certificado do emitente não é confiável"])
+
+    def test_signature_wrapping_is_rejected(self):
+        signed = sign_nfe_xml(build_nfe_xml(), self.key, self.cert)
+        forged = build_nfe_xml(numero_nf="666", valor_total=1.00)
+        forged_inf = forged[forged.index("<infNFe"):forged.index("</infNFe>") + len("</infNFe>")]
+        wrapped = signed.replace("<NFe>", "<NFe>" + forged_inf, 1)
+        errors = self.verifier.verify(wrapped)
+        self.assertEqual(errors, ["O documento deve conter exatamente um infNFe (encontrados 2)"])
+        with self.assertRaises(ValueError):
+            InvoiceAuditTool()._xml_to_dict(wrapped)
+
+    def test_signature_without_references_is_rejected(self):
+        from lxml import etree
+        root = etree.fromstring(sign_nfe_xml(build_nfe_xml(), self.key, self.cert).encode("utf-8"))
+        reference = root.find(".//{http://www.w3.org/2000/09/xmldsig#}Reference")
+        reference.getparent().remove(reference)
+        errors = self.verifier.verify(etree.tostring(root))
+        self.assertIn("A assinatura deve ter exatamente uma referência (encontradas 0)", errors)
+        self.assertTrue(any("deve ser coberto por exatamente uma assinatura" in error for error in errors))
+
+    def test_certificate_bound_to_emitter(self):
+        self.assertEqual(self.verifier.verify(sign_nfe_xml(build_nfe_xml(emit_cnpj="11222333000262"),
+                                                           self.key, self.cert)), [])
+        errors = self.verifier.verify(sign_nfe_xml(build_nfe_xml(emit_cnpj="11444777000161"), self.key, self.cert))
+        self.assertEqual(errors, ["Certificado da assinatura pertence ao CNPJ 11222333000181, não ao emitente 11444777000161"])
+
+    def test_certificate_validity_period(self):
+        # build_nfe_xml emite em 2024-01-15, antes do início da validade deste certificado
+        recent_key, recent_cert = make_test_certificate("Emitente Teste", cnpj="11222333000181",
+                                                        valid_days=(-1, 30))
+        self.assertEqual(self.verifier.verify(sign_nfe_xml(build_nfe_xml(), recent_key, recent_cert)),
+                         ["Certificado da assinatura fora do prazo de validade em 2024-01-15T10:00:00-03:00"])
+
+    def test_signature_errors_in_audit(self):
+        audit_tool = InvoiceAuditTool(signature_verifier=self.verifier)
+        invoice = audit_tool._xml_to_dict(build_nfe_xml())
+        audit_results = audit_tool._perform_audit(invoice, InvoiceValidator())
+        self.assertIn("Assinatura digital inválida: Assinatura digital ausente", audit_results["issues"])
+
+    def test_verify_files_in_parallel(self):
+        paths = []
+        for n in range(4):
+            path = os.path.join(self.tmpdir.name, f"nf_{n}.xml")
+            xml_string = sign_nfe_xml(build_nfe_xml(numero_nf=str(n + 1)), self.key, self.cert)
+            if n == 3:
+                xml_string = xml_string.replace("Produto A", "Produto B")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(xml_string)
+            paths.append(path)
+        results = self.verifier.verify_files(paths, workers=2)
+        self.assertEqual([len(results[path]) for path in paths], [0, 0, 0, 1])
+
+class TestFiscalCodeValidator(unittest.TestCase):
+    def setUp(self):
+        self.engine = nf.FiscalCodeValidator()
+        self.audit_tool = InvoiceAuditTool()
+
+    def test_cnpj_check_digits(self):
+        self.assertEqual(
+            self.engine.validate_cnpjs(["11222333000181", "11222333000182", "00000000000000", "1122233300018", "12ABC34501DE35"]),
+            [True, False, False, False, True]
+        )
+
+    def test_cpf_check_digits(self):
+        self.assertEqual(
+            self.engine.validate_cpfs(["52998224725", "52998224724", "11111111111", "5299822472A"]),
+            [True, False, False, False]
+        )
+
+    def test_access_key_check_digit(self):
+        self.assertEqual(
+            self.engine.validate_access_keys([
+                "35240111222333000181550010000010011000000012",
+                "35240111222333000181550010000010011000000013",
+                "3524011122233300018155001000001001100000001",
+            ]),
+            [True, False, False]
+        )
+
+    def test_ncm_and_cfop(self):
+        self.assertEqual(self.engine.validate_ncms(["84713012", "77000000", "8471301"]), [True, False, False])
+        self.assertEqual(self.engine.validate_cfops(["5102", "4102", "51020"]), [True, False, False])
+        tables = nf.FiscalCodeValidator(ncm_codes={"84713012"}, cfop_codes={"5102"})
+        self.assertEqual(tables.validate_cfops(["5102", "6102"]), [True, False])
+
+    def test_validate_invoices_batch(self):
+        invoices = [
+            self.audit_tool._xml_to_dict(build_nfe_xml()),
+            self.audit_tool._xml_to_dict(build_nfe_xml(dest_cnpj="11444777000162", cfop="9999")),
+        ]
+        results = self.engine.validate_invoices(invoices)
+        self.assertEqual(results[0], [])
+        self.assertEqual(len(results[1]), 2)
+        self.assertTrue(any("CNPJ do destinatário" in issue for issue in results[1]))
+
+    def test_invalid_codes_become_audit_issues(self):
+        invoice = self.audit_tool._xml_to_dict(build_nfe_xml(chave="35240111222333000181550010000010011000000013"))
+        audit_results = self.audit_tool._perform_audit(invoice, InvoiceValidator())
+        self.assertEqual(audit_results["status"], "FAILED")
+        self.assertTrue(any("Chave de acesso inválida" in issue for issue in audit_results["issues"]))
+
+    def test_batch_entry_points_validate_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for n in range(1, 4):
+                path = os.path.join(tmpdir, f"nf_{n}.xml")
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(build_nfe_xml(numero_nf=str(n), dest_cnpj="11444777000162" if n == 2 else "11444777000161"))
+                paths.append(path)
+            
+            tool = nf.InvoiceBatchAuditTool()
+            with mock.patch.object(nf.FiscalCodeValidator, "validate_invoices",
+                                   autospec=True, side_effect=nf.FiscalCodeValidator.validate_invoices) as validate:
+                results = tool.invoke({"invoices": paths})
+                asyncio.run(tool.ainvoke({"invoices": paths}))
+                
+                system = NFSystem()
+                system.triage = None
+                response = mock.Mock(text=json.dumps([
+                    {"id": str(n), "resumo": "ok", "avaliacao_risco": "baixo", "acoes_recomendadas": []} for n in (1, 2, 3)
+                ]))
+                with mock.patch.object(nf.model, "generate_content", return_value=response):
+                    system.analyze_invoices(paths)
+                
+                queue = nf.SQLiteJobQueue(os.path.join(tmpdir, "fila.db"))
+                queue.enqueue(paths)
+                nf.AuditWorker(queue, "w1", nf_system=system).run()
+                queue.close()
+        
+        self.assertEqual(validate.call_count, 4)
+        self.assertEqual([len(call.args[1]) for call in validate.call_args_list], [3, 3, 3, 3])
+        self.assertEqual([result["status"] for result in results], ["PASSED", "FAILED", "PASSED"])
+
+class TestPurchaseOrderMatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmpdir.name, "pedidos.csv")
+        with open(self.csv_path, 'w', encoding='utf-8') as f:
+            f.write("cnpj_fornecedor;numero_pedido;codigo;descricao;quantidade;valor_unitario\n")
+            f.write("11.222.333/0001-81;PC-10;P001;Produto A;5;50,00\n")
+            f.write("11.222.333/0001-81;PC-10;P002;Parafuso sextavado M8;100;0,50\n")
+        self.audit_tool = InvoiceAuditTool(purchase_order_matcher=nf.PurchaseOrderMatcher.from_csv(self.csv_path))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _issues(self, **kwargs):
+        invoice = self.audit_tool._xml_to_dict(build_nfe_xml(**kwargs))
+        return self.audit_tool._validate_purchase_order(invoice)
+
+    def test_matching_invoice(self):
+        self.assertEqual(self._issues(pedido="PC-10"), [])
+
+    def test_price_divergence(self):
+        issues = self._issues(pedido="PC-10", items=(("P001", "Produto A", 2, 55.00),))
+        self.assertEqual(len(issues), 1)
+        self.assertIn("Preço do produto P001", issues[0])
+
+    def test_fuzzy_description_fallback(self):
+        self.assertEqual(self._issues(pedido="PC-10", items=(("X-99", "PARAFUSO SEXTAVADO M8", 10, 0.50),)), [])
+
+    def test_unknown_order_and_missing_reference(self):
+        self.assertEqual(self._issues(pedido="PC-99"), ["Pedido de compra PC-99 não encontrado para o fornecedor"])
+        self.assertEqual(self._issues(), ["Produto P001 sem referência a pedido de compra"])
+
+    def _invoice(self, n, quantidade, codigo="P001"):
+        return self.audit_tool._xml_to_dict(build_nfe_xml(numero_nf=str(n), pedido="PC-10", chave=f"{n:044d}",
+                                                          items=((codigo, "Produto A", quantidade, 50.00),)))
+
+    def test_batch_quantity_exceeds_order(self):
+        results = self.audit_tool.purchase_order_matcher.match_invoices([self._invoice(1, 3), self._invoice(2, 3)])
+        self.assertEqual(len(results[0]), 1)
+        self.assertIn("excede o pedido PC-10", results[1][0])
+
+    def test_quantity_accumulates_across_calls(self):
+        matcher = self.audit_tool.purchase_order_matcher
+        self.assertEqual(matcher.match_invoices([self._invoice(1, 3)]), [[]])
+        # Reauditar a mesma nota não soma de novo
+        self.assertEqual(matcher.match_invoices([self._invoice(1, 3)]), [[]])
+        self.assertIn("(6) excede o pedido PC-10 (5)", matcher.match_invoices([self._invoice(2, 3)])[0][0])
+
+    def test_quantity_state_is_shared(self):
+        state_path = os.path.join(self.tmpdir.name, "faturado.db")
+        first = nf.PurchaseOrderMatcher.from_csv(self.csv_path, state_path=state_path)
+        second = nf.PurchaseOrderMatcher.from_csv(self.csv_path, state_path=state_path)
+        self.assertEqual(first.match_invoices([self._invoice(1, 3)]), [[]])
+        self.assertEqual(len(second.match_invoices([self._invoice(2, 3)])[0]), 1)
+        first.close()
+        second.close()
+
+    def test_repeated_order_lines_are_summed(self):
+        with open(self.csv_path, 'a', encoding='utf-8') as f:
+            f.write("11.222.333/0001-81;PC-10;P001;Produto A;5;55,00\n")
+        matcher = nf.PurchaseOrderMatcher.from_csv(self.csv_path)
+        self.assertEqual(matcher.match_invoices([self._invoice(1, 8)]), [[]])
+        invoice = self.audit_tool._xml_to_dict(build_nfe_xml(pedido="PC-10", chave=f"{2:044d}",
+                                                             items=(("P001", "Produto A", 1, 55.00),)))
+        self.assertEqual(matcher.match_invoices([invoice]), [[]])
+        self.assertEqual(len(matcher.match_invoices([self._invoice(3, 2)])[0]), 1)
+
+    def test_over_billing_across_analyzed_files(self):
+        system = NFSystem()
+        system.triage = None
+        system.configure(purchase_orders=self.csv_path)
+        paths = []
+        for n in (1, 2):
+            path = os.path.join(self.tmpdir.name, f"nf_{n}.xml")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf=str(n), pedido="PC-10", chave=f"{n:044d}",
+                                      items=(("P001", "Produto A", 3, 50.00),)))
+            paths.append(path)
+        outcomes = system._process_xmls([(nf.read_xml_file(path), path, None) for path in paths])
+        for _, audit_results, _ in outcomes:
+            self.assertTrue(any("excede o pedido PC-10" in issue for issue in audit_results["issues"]))
+
+    def test_sqlite_source(self):
+        import sqlite3
+        db_path = os.path.join(self.tmpdir.name, "pedidos.db")
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("CREATE TABLE pedidos (cnpj_fornecedor, numero_pedido, codigo, descricao, quantidade, valor_unitario)")
+            conn.execute("INSERT INTO pedidos VALUES ('11222333000181', 'PC-10', 'P001', 'Produto A', 5, 50.0)")
+        matcher = nf.PurchaseOrderMatcher.from_file(db_path)
+        invoice = self.audit_tool._xml_to_dict(build_nfe_xml(pedido="PC-10"))
+        self.assertEqual(matcher.match_invoices([invoice]), [[]])
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "fila.db")
+        self.now = [1000.0]
+        self.queue = nf.SQLiteJobQueue(self.db_path, lease_seconds=60, max_attempts=2,
+                                       retry_delay=0, clock=lambda: self.now[0])
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmpdir.cleanup()
+
+    def _write_invoices(self, count):
+        paths = []
+        for n in range(count):
+            path = os.path.join(self.tmpdir.name, f"nf_{n}.xml")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf=str(n + 1)))
+            paths.append(path)
+        return paths
+
+    def test_enqueue_is_idempotent(self):
+        paths = self._write_invoices(2)
+        self.assertEqual(self.queue.enqueue(paths), 2)
+        self.assertEqual(self.queue.enqueue(paths), 0)
+        self.assertEqual(self.queue.counts()["pending"], 2)
+
+    def test_expired_lease_is_reclaimed(self):
+        self.queue.enqueue(self._write_invoices(1))
+        job = self.queue.claim("worker-a")[0]
+        self.assertEqual(self.queue.claim("worker-b"), [])
+        
+        self.now[0] += 61
+        reclaimed = self.queue.claim("worker-b")
+        self.assertEqual([j["id"] for j in reclaimed], [job["id"]])
+        # O worker original perdeu o lease e não pode mais gravar o resultado
+        self.assertFalse(self.queue.complete(job["id"], "worker-a", {}))
+        self.assertTrue(self.queue.complete(job["id"], "worker-b", {"status": "PASSED"}))
+
+    def test_renew_extends_lease(self):
+        self.queue.enqueue(self._write_invoices(1))
+        job = self.queue.claim("worker-a")[0]
+        self.now[0] += 50
+        self.assertEqual(self.queue.renew([job["id"]], "worker-a"), 1)
+        self.assertEqual(self.queue.renew([job["id"]], "worker-b"), 0)
+        self.now[0] += 50
+        self.assertEqual(self.queue.claim("worker-b"), [])
+
+    def test_worker_renews_leases_of_slow_batch(self):
+        queue = nf.SQLiteJobQueue(os.path.join(self.tmpdir.name, "lenta.db"), lease_seconds=0.3)
+        queue.enqueue(self._write_invoices(2))
+        worker = nf.AuditWorker(queue, "worker-a", renew_interval=0.05)
+        other = nf.SQLiteJobQueue(queue.db_path, lease_seconds=0.3)
+        stolen = []
+        
+        def slow_batch(paths):
+            time.sleep(0.8)
+            stolen.extend(other.claim("worker-b", 10))
+            return [{"status": "PASSED"} for _ in paths]
+        
+        with mock.patch.object(worker, "_audit_batch", side_effect=slow_batch):
+            worker.run(until_empty=True)
+        self.assertEqual(stolen, [])
+        self.assertEqual(worker.stats["concluidos"], 2)
+        other.close()
+        queue.close()
+
+    def test_lost_lease_is_not_counted_as_done(self):
+        self.queue.enqueue(self._write_invoices(1))
+        worker = nf.AuditWorker(self.queue, "worker-a", renew_interval=1000)
+        stolen = []
+
+        def expired_batch(paths):
+            # O lease vence durante a auditoria e o job passa para outro worker
+            self.now[0] += 61
+            stolen.extend(self.queue.claim("worker-b"))
+            return [{"status": "PASSED"} for _ in paths]
+
+        with mock.patch.object(worker, "_audit_batch", side_effect=expired_batch):
+            worker.run(until_empty=True)
+        self.assertEqual(len(stolen), 1)
+        self.assertEqual(worker.stats, {"concluidos": 0, "falhas": 0, "leases_perdidos": 1})
+        self.assertEqual(self.queue.counts()["running"], 1)
+
+    def test_enqueue_is_one_transaction(self):
+        paths = [os.path.join(self.tmpdir.name, f"nf_{n}.xml") for n in range(5000)]
+        statements = []
+        self.queue._conn.set_trace_callback(statements.append)
+        self.assertEqual(self.queue.enqueue(paths), 5000)
+        self.queue._conn.set_trace_callback(None)
+        self.assertEqual([sql for sql in statements if sql in ("BEGIN IMMEDIATE", "COMMIT")], ["BEGIN IMMEDIATE", "COMMIT"])
+        self.assertEqual(self.queue.enqueue(paths[:10]), 0)
+
+    def test_backend_is_abstract(self):
+        with self.assertRaises(TypeError):
+            nf.JobQueueBackend()
+
+    def test_failures_go_to_dead_letter(self):
+        self.queue.enqueue([os.path.join(self.tmpdir.name, "inexistente.xml")])
+        worker = nf.AuditWorker(self.queue, "worker-a")
+        worker.run(until_empty=True)
+        self.assertEqual(worker.stats["falhas"], 2)
+        self.assertEqual(self.queue.counts()["dead"], 1)
+        self.assertEqual(self.queue.dead_letters()[0]["attempts"], 2)
+
+    def test_run_is_resumable(self):
+        paths = self._write_invoices(3)
+        self.queue.enqueue(paths)
+        # Simula uma execução interrompida após reservar um job
+        self.queue.claim("worker-interrompido")
+        self.now[0] += 61
+        worker = nf.AuditWorker(self.queue, "worker-b")
+        worker.run(until_empty=True)
+        self.assertEqual(worker.stats["concluidos"], 3)
+        self.assertEqual(self.queue.counts()["done"], 3)
+        
+        worker.run(until_empty=True)
+        self.assertEqual(worker.stats["concluidos"], 3)
+
+    def test_multiple_processes(self):
+        paths = self._write_invoices(6)
+        self.queue.enqueue(paths)
+        nf.run_queue_workers(self.db_path, processes=2)
+        results = self.queue.results()
+        self.assertEqual(sorted(r["numero_nf"] for r in results), ["1", "2", "3", "4", "5", "6"])
+        self.assertTrue(all(r["status"] == "PASSED" for r in results))
+
+class TestInvoiceArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir.name, "arquivo")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _append(self, archive, n):
+        xml_string = build_nfe_xml(numero_nf=str(n), chave=f"{n:044d}")
+        return archive.append(xml_string, {"numero_nf": str(n), "chave_acesso": f"{n:044d}", "status": "PASSED"})
+
+    def test_random_access_and_scan(self):
+        archive = nf.InvoiceArchive(self.directory, train_after=0)
+        for n in range(1, 21):
+            self._append(archive, n)
+        record = archive.get(chave_acesso=f"{7:044d}")
+        self.assertEqual(record["result"]["numero_nf"], "7")
+        self.assertIn(b"<nNF>7</nNF>", record["xml"])
+        self.assertEqual(archive.get(numero_nf="12")["result"]["chave_acesso"], f"{12:044d}")
+        self.assertIsNone(archive.get(numero_nf="999"))
+        self.assertEqual([r["result"]["numero_nf"] for r in archive.scan()], [str(n) for n in range(1, 21)])
+        archive.close()
+
+    def test_segments_roll_over_and_reopen(self):
+        archive = nf.InvoiceArchive(self.directory, segment_size=2048, train_after=0)
+        for n in range(1, 31):
+            self._append(archive, n)
+        archive.close()
+        self.assertGreater(len([name for name in os.listdir(self.directory) if name.startswith("segment-")]), 1)
+        
+        reopened = nf.InvoiceArchive(self.directory, segment_size=2048, train_after=0)
+        self._append(reopened, 31)
+        self.assertEqual(len(list(reopened.scan())), 31)
+        self.assertEqual(reopened.get(numero_nf="30")["result"]["status"], "PASSED")
+        reopened.close()
+
+    def test_dictionary_is_trained_and_used(self):
+        archive = nf.InvoiceArchive(self.directory, train_after=50, dict_size=4096)
+        for n in range(1, 101):
+            self._append(archive, n)
+        self.assertTrue(any(name.startswith("dict-") for name in os.listdir(self.directory)))
+        # Registros antigos (sem dicionário) e novos (com dicionário) continuam legíveis
+        self.assertEqual(archive.get(numero_nf="10")["result"]["numero_nf"], "10")
+        self.assertEqual(archive.get(numero_nf="90")["result"]["numero_nf"], "90")
+        archive.close()
+
+    def test_torn_write_is_discarded(self):
+        archive = nf.InvoiceArchive(self.directory, train_after=0)
+        self._append(archive, 1)
+        archive.close()
+        with open(os.path.join(self.directory, "segment-000001.dat"), 'ab') as f:
+            f.write(b"NFA1\x01lixo")
+        reopened = nf.InvoiceArchive(self.directory, train_after=0)
+        self._append(reopened, 2)
+        self.assertEqual([r["result"]["numero_nf"] for r in reopened.scan()], ["1", "2"])
+        reopened.close()
+
+    def test_unindexed_segment_after_rollover_is_discarded(self):
+        archive = nf.InvoiceArchive(self.directory, segment_size=2048, train_after=0)
+        for n in range(1, 7):
+            self._append(archive, n)
+        last_segment = archive._segment
+        archive.close()
+        # Queda logo depois da virada: o registro foi gravado no segmento novo, mas não no índice
+        with open(os.path.join(self.directory, f"segment-{last_segment + 1:06d}.dat"), 'wb') as f:
+            f.write(b"NFA1\x01registro-fantasma")
+
+        reopened = nf.InvoiceArchive(self.directory, segment_size=2048, train_after=0)
+        for n in range(7, 13):
+            self._append(reopened, n)
+        self.assertEqual([r["result"]["numero_nf"] for r in reopened.scan()], [str(n) for n in range(1, 13)])
+        reopened.close()
+
+    def test_records_lost_in_power_failure_leave_the_index(self):
+        archive = nf.InvoiceArchive(self.directory, train_after=0)
+        for n in range(1, 4):
+            self._append(archive, n)
+        lost_offset = archive._index.execute("SELECT offset FROM records WHERE numero_nf = '2'").fetchone()[0]
+        archive.close()
+        # Queda de energia: o índice tem os registros 2 e 3, mas o segmento parou no início do 2
+        with open(os.path.join(self.directory, "segment-000001.dat"), 'r+b') as f:
+            f.truncate(lost_offset)
+
+        reopened = nf.InvoiceArchive(self.directory, train_after=0)
+        self.assertIsNone(reopened.get(numero_nf="2"))
+        self._append(reopened, 4)
+        self.assertIsNone(reopened.get(chave_acesso=f"{2:044d}"))
+        self.assertEqual(reopened.get(chave_acesso=f"{4:044d}")["result"]["numero_nf"], "4")
+        self.assertEqual([r["result"]["numero_nf"] for r in reopened.scan()], ["1", "4"])
+        reopened.close()
+
+    def test_decode_xml_bytes_falls_back_to_latin1(self):
+        xml_string = build_nfe_xml().replace("Cliente Teste", "Distribuição Ltda")
+        self.assertIn("Distribuição Ltda", nf.decode_xml_bytes(xml_string.encode('iso-8859-1')))
+        self.assertIn("Distribuição Ltda", nf.decode_xml_bytes(xml_string.encode('utf-8')))
+
+class TestPriceHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "precos.db")
+        self.audit_tool = InvoiceAuditTool()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _invoice(self, n, price, codigo="P001"):
+        return self.audit_tool._xml_to_dict(build_nfe_xml(numero_nf=str(n), chave=f"{n:044d}",
+                                                          items=((codigo, "Produto A", 1, price),)))
+
+    def _feed(self, history, count, start=1):
+        # Preços oscilando entre 49,00 e 51,00
+        for n in range(start, start + count):
+            self.assertEqual(history.check_invoice(self._invoice(n, 49.0 + (n % 5) * 0.5)), [])
+
+    def test_streaming_quantile(self):
+        import random
+        rng = random.Random(7)
+        estimator = nf._P2Quantile(0.95)
+        for _ in range(20000):
+            estimator.add(rng.random())
+        self.assertAlmostEqual(estimator.value(), 0.95, delta=0.01)
+        self.assertEqual(len(estimator.to_state()["q"]), 5)
+
+    def test_outlier_flagged_after_min_history(self):
+        history = nf.PriceHistory(self.db_path, min_history=10)
+        self._feed(history, 30)
+        self.assertEqual(history.check_invoice(self._invoice(1000, 500.0, codigo="P999")), [])
+        issues = history.check_invoice(self._invoice(2000, 80.0))
+        self.assertEqual(len(issues), 1)
+        self.assertIn("Preço do produto P001 acima do histórico do fornecedor: 80.00", issues[0])
+        self.assertEqual(history.check_invoice(self._invoice(2001, 50.5)), [])
+        history.close()
+
+    def test_flagged_prices_do_not_feed_history(self):
+        history = nf.PriceHistory(self.db_path, min_history=10)
+        self._feed(history, 20)
+        # Sobrepreço repetido continua apontado: os valores atípicos não entram na média
+        for n in range(100, 140):
+            self.assertEqual(len(history.check_invoice(self._invoice(n, 80.0))), 1)
+        entry = history._get(("11222333000181", "P001"))
+        self.assertEqual(entry["count"], 20)
+        self.assertAlmostEqual(entry["mean"], 50.0, places=6)
+        history.close()
+
+    def test_reset_accepts_new_price_level(self):
+        history = nf.PriceHistory(self.db_path, min_history=10)
+        self._feed(history, 20)
+        self.assertEqual(len(history.check_invoice(self._invoice(100, 80.0))), 1)
+        # Reajuste aceito: o histórico recomeça e o novo patamar deixa de ser apontado
+        self.assertTrue(history.reset("11222333000181", "P001"))
+        for n in range(101, 131):
+            self.assertEqual(history.check_invoice(self._invoice(n, 80.0)), [])
+        history.close()
+        
+        reopened = nf.PriceHistory(self.db_path)
+        entry = reopened._get(("11222333000181", "P001"))
+        self.assertEqual(entry["count"], 30)
+        self.assertAlmostEqual(entry["mean"], 80.0, places=6)
+        self.assertFalse(reopened.reset("11222333000181", "P999"))
+        reopened.close()
+
+    def test_persistence_and_reaudit_does_not_double_count(self):
+        history = nf.PriceHistory(self.db_path, flush_every=7)
+        self._feed(history, 20)
+        history.close()
+        
+        reopened = nf.PriceHistory(self.db_path)
+        self._feed(reopened, 20)
+        entry = reopened._get(("11222333000181", "P001"))
+        self.assertEqual(entry["count"], 20)
+        self.assertAlmostEqual(entry["mean"], 50.0, places=6)
+        reopened.close()
+
+    def test_cache_is_bounded(self):
+        history = nf.PriceHistory(self.db_path, max_keys=5)
+        for n in range(1, 201):
+            history.check_invoice(self._invoice(n, 10.0 + n % 3, codigo=f"P{n % 20:03d}"))
+            self.assertLessEqual(len(history._cache), 5)
+        history.close()
+        
+        reopened = nf.PriceHistory(self.db_path)
+        self.assertEqual(sum(reopened._get(("11222333000181", f"P{k:03d}"))["count"] for k in range(20)), 200)
+        reopened.close()
+
+    def test_shared_mode_and_audit_integration(self):
+        writer = nf.PriceHistory(self.db_path, shared=True)
+        self._feed(writer, 15)
+        writer.close()
+        
+        audit_tool = InvoiceAuditTool(price_history=nf.PriceHistory(self.db_path, shared=True))
+        results = audit_tool._perform_audit(self._invoice(999, 90.0), InvoiceValidator())
+        self.assertTrue(any("acima do histórico" in issue for issue in results["issues"]))
+        audit_tool.price_history.close()
+
+class TestAsyncTools(unittest.TestCase):
+    def test_arun_matches_run(self):
+        tool = InvoiceAuditTool()
+        xml_string = build_nfe_xml()
+        result = asyncio.run(tool.ainvoke(xml_string))
+        self.assertIn("Número da NF: 1001", result)
+        self.assertIn("APROVADO", result)
+
+    def test_arun_does_not_block_event_loop(self):
+        tool = InvoiceAuditTool()
+        ticks = []
+        
+        def slow_run(invoice_data):
+            time.sleep(0.2)
+            return "ok"
+        
+        async def ticker():
+            for _ in range(3):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.02)
+        
+        async def main():
+            return await asyncio.gather(tool._arun("<xml/>"), ticker())
+        
+        with mock.patch.object(InvoiceAuditTool, "_run", side_effect=slow_run):
+            started = time.monotonic()
+            result, _ = asyncio.run(main())
+        self.assertEqual(result, "ok")
+        self.assertLess(ticks[-1] - started, 0.15)
+
+    def test_batch_tool_accepts_xml_and_paths(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "nf.xml")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(build_nfe_xml(numero_nf="2"))
+            tool = nf.InvoiceBatchAuditTool()
+            entries = [build_nfe_xml(numero_nf="1"), path, os.path.join(tmpdir, "inexistente.xml")]
+            sync_results = tool.invoke({"invoices": entries})
+            async_results = asyncio.run(tool.ainvoke({"invoices": entries}))
+        
+        self.assertEqual(sync_results, async_results)
+        self.assertEqual([r.get("numero_nf") for r in sync_results], ["1", "2", None])
+        self.assertEqual(sync_results[0]["entrada"], "xml[0]")
+        self.assertEqual(sync_results[1]["status"], "PASSED")
+        self.assertIn("erro", sync_results[2])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file